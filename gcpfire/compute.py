@@ -1,158 +1,554 @@
 from __future__ import annotations
 
+import asyncio
+import atexit
+import inspect
 import os
+import socket
+import threading
 import time
-from typing import Any, List
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import lru_cache, partial
+from queue import Queue
+from typing import Any, Dict, List, Optional, Set, Tuple, Type
 
+import google_auth_httplib2
+import httplib2
 from google.oauth2 import service_account
 from googleapiclient.discovery import Resource, build
+from googleapiclient.errors import HttpError
+from googleapiclient.http import HttpRequest
 
-from gcpfire.instance import Instance, InstanceSpecBuilder
-from gcpfire.keys import generate_keypair, write_privatekey
+from gcpfire.discovery_cache import DiscoveryCache
+from gcpfire.instance import RETRY_TIMEOUT, Instance, InstanceSpecBuilder
+from gcpfire.keys import generate_keypair_cached, prewarm_keys, write_privatekey
 from gcpfire.logger import logger
+from gcpfire.model import OrjsonModel
+from gcpfire.operations import OperationTracker
 
 from .job import JobSpec
 
 SERVICE_ACCOUNT_FILE = os.getenv("GOOGLE_APPLICATION_CREDENTIALS")
 HARD_LIMIT_MAX_INSTANCES = 10
+OPERATION_WAIT_TIMEOUT = 120  # seconds zoneOperations().wait blocks server-side at most
+HTTP_TIMEOUT = OPERATION_WAIT_TIMEOUT + 30  # socket timeout, has to outlast the long-poll of `wait`
+IMAGE_LINK_TTL = 600  # seconds we reuse the latest image of a family before looking it up again
 
+# Partial responses: only ask the API for the fields we actually read.
+IMAGE_FIELDS = "selfLink"
+INSTANCE_FIELDS = "metadata,networkInterfaces/accessConfigs/natIP"
+INSTANCE_STATUS_FIELDS = f"status,{INSTANCE_FIELDS}"
+INSTANCE_IP_FIELDS = "networkInterfaces/accessConfigs/natIP"
+INSTANCE_LIST_FIELDS = "items(name,zone),nextPageToken"
+OPERATION_FIELDS = "name,status,error"
+OPERATION_NAME_FIELDS = "name"
 
-def get_credentials() -> service_account.Credentials:
+
+_local = threading.local()
+_image_links: Dict[Tuple[str, str], Tuple[float, str]] = {}  # (project, family) -> (lookup time, self link)
+
+
+@lru_cache(maxsize=4)
+def _load_credentials(service_account_file: str) -> service_account.Credentials:
     return service_account.Credentials.from_service_account_file(
-        SERVICE_ACCOUNT_FILE, scopes=["https://www.googleapis.com/auth/compute"]
+        service_account_file, scopes=["https://www.googleapis.com/auth/compute"]
     )
 
 
+def get_credentials(service_account_file: Optional[str] = None) -> service_account.Credentials:
+    """Credentials of the service account. The key file is parsed only once per process and file.
+
+    Args:
+        service_account_file (Optional[str], optional): path to the key file. Defaults to SERVICE_ACCOUNT_FILE.
+
+    Returns:
+        service_account.Credentials: credentials (thread-safe, so they are shared by all connections).
+    """
+    return _load_credentials(service_account_file or SERVICE_ACCOUNT_FILE)
+
+
+def get_authorized_http() -> google_auth_httplib2.AuthorizedHttp:
+    """Authorized keep-alive connection of the current thread, so we only pay the TLS handshake once per thread.
+    httplib2 is not thread-safe, which is why the connection is not shared between threads.
+    """
+    http = getattr(_local, "http", None)
+    if http is None:
+        http = google_auth_httplib2.AuthorizedHttp(get_credentials(), http=httplib2.Http(timeout=HTTP_TIMEOUT))
+        _local.http = http
+    return http
+
+
+def build_request(http: Any, *args: Any, **kwargs: Any) -> HttpRequest:
+    """Send every request over the connection of the calling thread, not the one the client was built with."""
+    return HttpRequest(get_authorized_http(), *args, **kwargs)
+
+
+@lru_cache(maxsize=1)
 def get_compute_client() -> Resource:
+    """Build the Compute client (once) from the discovery document that ships with google-api-python-client>=2
+    (no network access at all) or, for older versions, from our on-disk cache. It is shared by all threads.
+    """
     logger.debug("Building Compute Client.")
-    credentials = get_credentials()
-    return build("compute", "v1", credentials=credentials, cache_discovery=False)
+    discovery: Dict[str, Any] = {"cache_discovery": True, "cache": DiscoveryCache()}
+    if "static_discovery" in inspect.signature(build).parameters:
+        discovery = {"static_discovery": True}
+    return build(
+        "compute",
+        "v1",
+        http=get_authorized_http(),
+        requestBuilder=build_request,
+        model=OrjsonModel(),
+        **discovery,
+    )
+
+
+def get_cached_image_link(project: str, family: str) -> Optional[str]:
+    """Image link of an earlier lookup of the family, None if there is none or it is older than IMAGE_LINK_TTL."""
+    cached = _image_links.get((project, family))
+    if cached is not None and time.time() - cached[0] < IMAGE_LINK_TTL:
+        return cached[1]
+    return None
+
+
+def cache_image_link(project: str, family: str, image_link: str) -> None:
+    _image_links[(project, family)] = (time.time(), image_link)
+
+
+def listed_instances(result: Any) -> Optional[List[Any]]:
+    """Instances of an `instances().list` response (the first page only, see ComputeAPI.list_instances_request).
+
+    Returns:
+        Optional[List[Any]]: instances or None if there are none.
+    """
+    instances = result.get("items", [])
+    return instances if len(instances) > 0 else None
+
+
+def ssh_key_entry(public_key: bytes, username: str = "gcpfire") -> str:
+    """Format a public key for the `ssh-keys` instance metadata."""
+    return f"{username}:{public_key.decode()}"
 
 
 class ComputeAPI:
     project: str
     zone: str
-    compute: Resource
+    operation_tracker: Optional[OperationTracker] = None
+    use_operation_wait = True  # switched off if the endpoint (e.g. an emulator) does not implement `wait`
 
     def __init__(self, project: str, zone: str) -> None:
         logger.info("Creating Compute API Instance.")
         self.project = project
         self.zone = zone
-        self.compute = get_compute_client()
+        self._reaper_queue: Queue[str] = Queue()
+        self._reaper: Optional[threading.Thread] = None
+        self._reaper_lock = threading.Lock()
+        get_compute_client()  # fail early if we have no credentials
+
+    @property
+    def compute(self) -> Resource:
+        return get_compute_client()
 
     def get_image_link(self, project: str, family: str) -> Any:
         # TODO: enable global images (currently limited to images from OUR project)
-        # Get the latest image
-        logger.debug(f"Getting image {family} from project {project}")
-        image_response = self.compute.images().getFromFamily(project=project, family=family).execute()
-        logger.debug(f"Got {image_response['selfLink']}")
+        # Get the latest image (the head of a family changes rarely, so we reuse it for a while)
+        image_link = get_cached_image_link(project, family)
+        if image_link is not None:
+            return image_link
+        logger.debug("Getting image %s from project %s", family, project)
+        image_response = (
+            self.compute.images().getFromFamily(project=project, family=family, fields=IMAGE_FIELDS).execute()
+        )
+        logger.debug("Got %s", image_response["selfLink"])
+        cache_image_link(project, family, image_response["selfLink"])
         return image_response["selfLink"]
 
+    def get_job_resources(
+        self, project: str, family: str, instance_name: str
+    ) -> Tuple[Any, Optional[List[Any]], Optional[Any]]:
+        """Look up the image, list the instances and get the instance of a job in a single batched HTTP request instead
+        of three round-trips. If the image link is cached, it is not looked up again.
+
+        The instance is fetched by name, because the list is truncated above our limit and might not contain it.
+
+        Args:
+            project (str): project the image family belongs to.
+            family (str): image family. We use the latest image of that family.
+            instance_name (str): instance of the job in our zone.
+
+        Raises:
+            Exception: the first error any of the batched requests returned.
+
+        Returns:
+            Tuple[Any, Optional[List[Any]], Optional[Any]]: image self link, instances (None if there are no
+                instances) and the job's instance with INSTANCE_STATUS_FIELDS (None if it does not exist).
+        """
+        image_link = get_cached_image_link(project, family)
+        responses: Dict[str, Any] = {"instance": None}
+
+        def callback(request_id: str, response: Any, exception: Optional[Exception]) -> None:
+            if exception is not None:
+                if request_id == "instance" and isinstance(exception, HttpError) and exception.resp.status == 404:
+                    return
+                raise exception
+            responses[request_id] = response
+
+        logger.debug(
+            "Getting image %s from project %s, instance %s and listing instances.", family, project, instance_name
+        )
+        batch = self.compute.new_batch_http_request(callback=callback)
+        if image_link is None:
+            batch.add(
+                self.compute.images().getFromFamily(project=project, family=family, fields=IMAGE_FIELDS),
+                request_id="image",
+            )
+        batch.add(self.list_instances_request(), request_id="instances")
+        batch.add(
+            self.compute.instances().get(
+                project=self.project, zone=self.zone, instance=instance_name, fields=INSTANCE_STATUS_FIELDS
+            ),
+            request_id="instance",
+        )
+        batch.execute()
+
+        if image_link is None:
+            image_link = responses["image"]["selfLink"]
+            logger.debug("Got %s", image_link)
+            cache_image_link(project, family, image_link)
+        return image_link, listed_instances(responses["instances"]), responses["instance"]
+
     def create_instance(self, builder: InstanceSpecBuilder) -> Any:
         logger.info(f"Creating Instance {builder.name}.")
         instance_spec = builder.build(self.project, self.zone)
         request = (
-            self.compute.instances().insert(project=self.project, zone=self.zone, body=instance_spec.config).execute()
+            self.compute.instances()
+            .insert(project=self.project, zone=self.zone, body=instance_spec.config, fields=OPERATION_NAME_FIELDS)
+            .execute()
         )
         result = self.wait_for_response(request["name"])
         return result
 
-    def wait_for_response(self, operation: Any) -> Any:
-        logger.info("Waiting for operation to finish...")
-        while True:
-            result = (
-                self.compute.zoneOperations().get(project=self.project, zone=self.zone, operation=operation).execute()
+    def create_instances(self, builders: List[InstanceSpecBuilder]) -> List[Any]:
+        """Create several instances with a single batched insert request and wait for all of them with one shared
+        poller.
+
+        Raises:
+            Exception: the first error of an insert or one of the operations, after all others have finished.
+
+        Returns:
+            List[Any]: the finished insert operations, in the same order as `builders`.
+        """
+        operations: Dict[str, Any] = {}
+        errors: List[Exception] = []
+
+        def callback(request_id: str, response: Any, exception: Optional[Exception]) -> None:
+            if exception is not None:
+                errors.append(exception)
+            else:
+                operations[request_id] = response["name"]
+
+        batch = self.compute.new_batch_http_request(callback=callback)
+        for builder in builders:
+            logger.info(f"Creating Instance {builder.name}.")
+            instance_spec = builder.build(self.project, self.zone)
+            batch.add(
+                self.compute.instances().insert(
+                    project=self.project, zone=self.zone, body=instance_spec.config, fields=OPERATION_NAME_FIELDS
+                ),
+                request_id=builder.name,
             )
+        batch.execute()
+
+        logger.info("Waiting for %d operations to finish...", len(operations))
+        tracker = self.operation_tracker or OperationTracker(self.compute, self.project, self.zone)
+        futures = [tracker.wait_async(operations[builder.name]) for builder in builders if builder.name in operations]
+        results = []
+        for future in futures:  # wait for all of them before we raise anything
+            try:
+                results.append(self.check_operation(future.result()))
+            except Exception as e:
+                errors.append(e)
+        if len(errors) > 0:
+            raise errors[0]
+        return results
+
+    def poll_operation(self, operation: Any) -> Any:
+        """Fetch the state of a zone operation. Prefers the `wait` long-poll, which blocks server-side until the
+        operation is DONE (or ~2 minutes have passed), so we neither sleep client-side nor hammer the API. If the
+        connection times out before the operation is done, the operation is reported as still running, so the caller
+        simply polls again.
+
+        Args:
+            operation (Any): name of the zone operation.
+
+        Returns:
+            Any: the operation resource.
+        """
+        operations = self.compute.zoneOperations()
+        if self.use_operation_wait and hasattr(operations, "wait"):
+            try:
+                return operations.wait(
+                    project=self.project, zone=self.zone, operation=operation, fields=OPERATION_FIELDS
+                ).execute()
+            except (socket.timeout, TimeoutError):
+                logger.debug("Waiting for operation %s timed out, polling again.", operation)
+                return {"name": operation, "status": "RUNNING"}
+            except HttpError as e:
+                if e.resp.status not in (404, 501):
+                    raise
+                logger.warning("zoneOperations.wait not supported (HTTP %s), falling back to polling.", e.resp.status)
+                self.use_operation_wait = False
+        # fall back to plain polling if the discovery document or the endpoint does not know about `wait`
+        time.sleep(1)
+        return operations.get(
+            project=self.project, zone=self.zone, operation=operation, fields=OPERATION_FIELDS
+        ).execute()
 
-            if result["status"] == "DONE":
-                logger.info("done.")
-                if "error" in result:
-                    errors = result["error"]["errors"]  # nice google!
-                    if len(errors) == 1 and errors[0]["code"] == "ZONE_RESOURCE_POOL_EXHAUSTED":
-                        raise NoResourcesError(errors[0]["message"])  # try to map error
-                    elif len(errors) == 1:
-                        raise Exception(errors[0]["message"])  # it's unknown so we raise a generic error
-                    else:
-                        raise Exception(result["error"])  # multiple errors(?)
-                else:
-                    return result
-
-            time.sleep(1)
+    def wait_for_response(self, operation: Any) -> Any:
+        logger.info("Waiting for operation to finish...")
+        if self.operation_tracker is not None:
+            # many jobs are in flight (fire_many), so share one poller instead of a request per operation
+            result = self.operation_tracker.wait_async(operation).result()
+        else:
+            result = self.poll_operation(operation)
+            while result["status"] != "DONE":
+                result = self.poll_operation(operation)
+
+        logger.info("done.")
+        return self.check_operation(result)
+
+    def check_operation(self, result: Any) -> Any:
+        """Raise the (mapped) error of a DONE operation, otherwise return the operation."""
+        if "error" in result:
+            errors = result["error"]["errors"]  # nice google!
+            if len(errors) == 1:
+                # try to map error, if it's unknown we raise a generic error
+                raise _ERR_MAP.get(errors[0]["code"], Exception)(errors[0]["message"])
+            else:
+                raise Exception(result["error"])  # multiple errors(?)
+        else:
+            return result
+
+    def list_instances_request(self) -> Any:
+        """Request listing the live instances in our zone, which count towards HARD_LIMIT_MAX_INSTANCES. Terminated
+        instances are filtered out server-side and only name and zone are returned. One instance more than we allow is
+        enough to tell if we are above the limit, so that's all we ask for: the result is only the first page (a
+        `nextPageToken` in it means there are even more).
+        """
+        return self.compute.instances().list(
+            project=self.project,
+            zone=self.zone,
+            filter="status != TERMINATED",
+            fields=INSTANCE_LIST_FIELDS,
+            maxResults=HARD_LIMIT_MAX_INSTANCES + 1,
+        )
 
     def list_instances(self) -> Any:
-        result = self.compute.instances().list(project=self.project, zone=self.zone).execute()
-        return result["items"] if "items" in result else None
-
-    def update_external_ip(self, instance: Instance) -> None:
-        logger.debug(f"Getting instance {instance.name} data.")
-        request_instance_get = (
-            self.compute.instances().get(project=self.project, zone=self.zone, instance=instance.name).execute()
-        )
-        if request_instance_get is not None:
-            logger.debug("Instance metadata:\n" + str(request_instance_get["metadata"]))
-            external_ip = request_instance_get["networkInterfaces"][0]["accessConfigs"][0]["natIP"]
-            logger.info(f"Instance {instance.name} external ip is {external_ip}")
-            instance.external_ip = external_ip
-
-    def add_ssh_keys(self, instance: Instance, username: str = "gcpfire") -> None:
-        logger.debug(f"Getting instance {instance.name} data.")
-        request_instance_get = (
-            self.compute.instances().get(project=self.project, zone=self.zone, instance=instance.name).execute()
+        return listed_instances(self.list_instances_request().execute())
+
+    def get_instance_data(self, instance: Instance, fields: str = INSTANCE_FIELDS) -> Any:
+        """Fetch the instance resource once and remember the parts we need later (external ip and metadata) on the
+        Instance, so callers can pass the result around instead of issuing another `instances().get`.
+
+        Args:
+            instance (Instance): the instance, gets external_ip (and metadata, if requested) set.
+            fields (str, optional): partial response mask. Use INSTANCE_IP_FIELDS if only the ip is needed. Defaults
+                to INSTANCE_FIELDS.
+
+        Raises:
+            InstanceNotExistsError: GCP does not know about the instance.
+        """
+        logger.debug("Getting instance %s data.", instance.name)
+        instance_data = (
+            self.compute.instances()
+            .get(project=self.project, zone=self.zone, instance=instance.name, fields=fields)
+            .execute()
         )
+        if instance_data is None:
+            logger.error(f"Instance {instance.name} does not exist.")
+            raise InstanceNotExistsError
 
-        if request_instance_get is not None:
-            logger.debug("Instance metadata:\n" + str(request_instance_get["metadata"]))
+        self.set_instance_data(instance, instance_data)
+        return instance_data
 
-            keys = []
-            other_items = []
-            fingerprint = request_instance_get["metadata"]["fingerprint"]
-            for meta_item in request_instance_get["metadata"]["items"]:
-                if meta_item["key"] == "ssh-keys":
-                    keys.extend(meta_item["value"].split("\n"))
-                else:
-                    other_items.append(meta_item)
+    def set_instance_data(self, instance: Instance, instance_data: Any) -> None:
+        """Remember external ip and metadata of an instance resource we already fetched on the Instance."""
+        instance.external_ip = instance_data["networkInterfaces"][0]["accessConfigs"][0]["natIP"]
+        if "metadata" in instance_data:
+            logger.debug("Instance metadata:\n%s", instance_data["metadata"])
+            instance.metadata = instance_data["metadata"]
 
+    def update_external_ip(self, instance: Instance, instance_data: Optional[Any] = None) -> None:
+        if instance_data is None:
+            self.get_instance_data(instance)
+        else:
+            instance.external_ip = instance_data["networkInterfaces"][0]["accessConfigs"][0]["natIP"]
+        logger.info(f"Instance {instance.name} external ip is {instance.external_ip}")
+
+    def add_ssh_keys(
+        self,
+        instance: Instance,
+        username: str = "gcpfire",
+        instance_data: Optional[Any] = None,
+        keypair: Optional[Tuple[bytes, bytes]] = None,
+    ) -> None:
+        """Make sure our public key is in the ssh-keys metadata of the instance and write the private key to disk.
+
+        Args:
+            instance (Instance): the instance, gets external_ip and private_key_file set.
+            username (str, optional): remote user name. Defaults to "gcpfire".
+            instance_data (Optional[Any], optional): result of get_instance_data(), fetched if not given.
+            keypair (Optional[Tuple[bytes, bytes]], optional): pre-generated (private, public) key, generated (or taken
+                from the cache) if not given.
+        """
+        if instance_data is None:
+            instance_data = self.get_instance_data(instance)
+
+        fingerprint = instance_data["metadata"]["fingerprint"]
+        meta_items = instance_data["metadata"].get("items", [])
+        ssh_items = [item for item in meta_items if item["key"] == "ssh-keys"]
+        other_items = [item for item in meta_items if item["key"] != "ssh-keys"]
+        existing_keys = ssh_items[0]["value"] if len(ssh_items) > 0 else ""
+
+        if keypair is None:
             logger.info("Generating keypair.")
-            priv, pub = generate_keypair(username)
-            private_key_file = write_privatekey(priv, instance.name, outpath=os.path.join(os.getcwd(), "secrets"))
-            logger.info(f"Private key file available at: {private_key_file}")
+            keypair = generate_keypair_cached(username)
+        priv, pub = keypair
+        self.attach_private_key(instance, priv)
 
-            keys.append(f"{username}:{pub.decode()}")
-
-            body = {"items": [{"key": "ssh-keys", "value": "\n".join(keys)}, *other_items], "fingerprint": fingerprint}
+        new_key = ssh_key_entry(pub, username)
+        if new_key in existing_keys:
+            logger.info(f"Public key is already present on Instance (user:{username}).")
+        else:
+            keys = existing_keys + "\n" + new_key if existing_keys else new_key
+            body = {"items": [{"key": "ssh-keys", "value": keys}, *other_items], "fingerprint": fingerprint}
 
             logger.info(f"Adding public key to Instance (user:{username})...")
             request_instance_setMetadata = (
                 self.compute.instances()
-                .setMetadata(project=self.project, zone=self.zone, instance=instance.name, body=body)
+                .setMetadata(
+                    project=self.project,
+                    zone=self.zone,
+                    instance=instance.name,
+                    body=body,
+                    fields=OPERATION_NAME_FIELDS,
+                )
                 .execute()
             )
             self.wait_for_response(request_instance_setMetadata["name"])
 
-            external_ip = request_instance_get["networkInterfaces"][0]["accessConfigs"][0]["natIP"]
+        instance.external_ip = instance_data["networkInterfaces"][0]["accessConfigs"][0]["natIP"]
+
+    def attach_private_key(self, instance: Instance, private_key: bytes) -> None:
+        """Write the private key for ssh logins into the instance to disk (./secrets)."""
+        private_key_file = write_privatekey(private_key, instance.name, outpath=os.path.join(os.getcwd(), "secrets"))
+        logger.info(f"Private key file available at: {private_key_file}")
+        instance.private_key_file = private_key_file
+
+    def snapshot_boot_disk(self, instance: Instance, snapshot_name: str) -> str:
+        """Snapshot the boot disk of an instance (e.g. after it has been set up once), so later jobs can boot from it
+        with JobSpec.source_snapshot instead of initializing the image from scratch.
+
+        Args:
+            instance (Instance): instance whose boot disk (named like the instance) is snapshotted.
+            snapshot_name (str): name of the new snapshot.
+
+        Returns:
+            str: link of the snapshot, to be used as source_snapshot.
+        """
+        logger.info(f"Creating snapshot {snapshot_name} of Instance {instance.name}")
+        operation = (
+            self.compute.disks()
+            .createSnapshot(
+                project=self.project,
+                zone=self.zone,
+                disk=instance.name,
+                body={"name": snapshot_name},
+                fields=OPERATION_NAME_FIELDS,
+            )
+            .execute()
+        )
+        self.wait_for_response(operation["name"])
+        return f"projects/{self.project}/global/snapshots/{snapshot_name}"
 
-            instance.external_ip = external_ip
-            instance.private_key_file = private_key_file
-        else:
-            logger.error(f"Instance {instance.name} does not exist.")
-            raise InstanceNotExistsError
+    def start_instance(self, instance: Instance) -> Any:
+        """Start a stopped (TERMINATED) instance and wait until it is running."""
+        logger.info(f"Starting Instance {instance.name}")
+        request = (
+            self.compute.instances()
+            .start(project=self.project, zone=self.zone, instance=instance.name, fields=OPERATION_NAME_FIELDS)
+            .execute()
+        )
+        return self.wait_for_response(request["name"])
 
     def delete_instance(self, instance: Instance) -> Any:
         logger.info(f"Deleting Instance {instance.name}")
-        return self.compute.instances().delete(project=self.project, zone=self.zone, instance=instance.name).execute()
+        return (
+            self.compute.instances()
+            .delete(project=self.project, zone=self.zone, instance=instance.name, fields=OPERATION_NAME_FIELDS)
+            .execute()
+        )
 
-    def cleanup(self, instance: Instance, wait: bool) -> None:
+    def reap(self, operation: Any) -> None:
+        """Wait for the operation in a background thread and only log if it failed. For operations nobody has to wait
+        for, like deleting an instance we are done with.
+        """
+        with self._reaper_lock:
+            if self._reaper is None:
+                self._reaper = threading.Thread(target=self._reap_operations, name="gcpfire-reaper", daemon=True)
+                self._reaper.start()
+                atexit.register(self._log_stragglers)
+        self._reaper_queue.put(operation)
+
+    def _reap_operations(self) -> None:
+        while True:
+            operation = self._reaper_queue.get()
+            try:
+                self.wait_for_response(operation)
+            except Exception as e:
+                logger.error(f"Operation {operation} failed: {e}")
+            finally:
+                self._reaper_queue.task_done()
+
+    def wait_for_reaped_operations(self) -> None:
+        """Block until all operations handed to reap() are finished."""
+        self._reaper_queue.join()
+
+    def _log_stragglers(self) -> None:
+        pending = self._reaper_queue.unfinished_tasks
+        if pending > 0:
+            logger.info(f"{pending} operation(s) (e.g. instance deletions) still running, they will finish on GCP.")
+
+    def cleanup(self, instance: Instance, wait: bool, wait_for_delete: bool = False) -> None:
+        """Delete the instance and the local key file.
+
+        Args:
+            instance (Instance): instance to delete.
+            wait (bool): Ask for confirmation before deleting (and wait for the deletion).
+            wait_for_delete (bool, optional): Block until the instance is deleted. Otherwise the deletion finishes in
+                the background and failures are only logged. Defaults to False.
+        """
         if wait:
             input(f"DELETE instance {instance.name}? [Enter]")
-        request = self.delete_instance(instance)
-        self.wait_for_response(request["name"])
+        try:
+            request = self.delete_instance(instance)
+        except HttpError as e:
+            if e.resp.status != 404:
+                raise
+            # e.g. the insert failed, so there is nothing to delete
+            logger.info(f"Instance {instance.name} does not exist (anymore).")
+        else:
+            if wait or wait_for_delete:
+                self.wait_for_response(request["name"])
+            else:
+                # the instance goes away no matter if we wait for it, so don't block the caller
+                self.reap(request["name"])
 
         instance.delete_local_keyfile()
 
-    def fire(self, job: JobSpec, wait: bool = False, retry_wait: int = 5, max_retry: int = 5) -> List[bytes]:
-        image_link = self.get_image_link(self.project, job.image_name)
-
-        builder = InstanceSpecBuilder(
+    def spec_builder(
+        self, job: JobSpec, image_link: str, public_key: Optional[bytes] = None, username: str = "gcpfire"
+    ) -> InstanceSpecBuilder:
+        return InstanceSpecBuilder(
             job.job_name,
             image_link,
             job.additional_meta,
@@ -160,37 +556,209 @@ class ComputeAPI:
             job.accelerators,
             job.preemptible,
             job.startup_script_path,
+            ssh_keys=ssh_key_entry(public_key, username) if public_key is not None else None,
+            disk_size_gb=job.disk_size_gb,
+            source_snapshot=job.source_snapshot,
         )
 
-        instances = self.list_instances()
-        if instances is not None and len(instances) > HARD_LIMIT_MAX_INSTANCES:
-            raise TooManyInstancesError
-
-        # we could return the instance right here, but for now we will populate the instances directly from the API
-        # so we know it really exists. As of now, there is no real benefit of tracking instance states also in gcpfire
-        # because we will throw away the instance anyway after executing the next few lines of code.
-        self.create_instance(builder)
-
-        instances = self.list_instances()
-        if instances is not None:
-            logger.info("Instances in project %s and zone %s:" % (self.project, self.zone))
-            for instance in instances:
-                logger.info(" - " + instance["name"])
-        else:
-            raise NoInstancesError
-
-        this_instance = Instance(builder.name, self.project, self.zone)
-        # self.update_external_ip(this_instance)
-        self.add_ssh_keys(this_instance)  # add ssh keys to instance
-
+    def fire(
+        self,
+        job: JobSpec,
+        wait: bool = False,
+        retry_wait: float = 0.5,
+        max_retry: int = 20,
+        timeout: float = RETRY_TIMEOUT,
+    ) -> bytes:
+        """Run the job on a new instance (or the one left over from an earlier run of it) and delete the instance
+        afterwards.
+
+        Args:
+            job (JobSpec): job to execute.
+            wait (bool, optional): Ask for confirmation before deleting the instance. Defaults to False.
+            retry_wait (float, optional): Seconds to wait before the first ssh retry (backs off from there). Defaults
+                to 0.5.
+            max_retry (int, optional): Retry the ssh connection test if it fails. Defaults to 20.
+            timeout (float, optional): Seconds after which no further ssh retry is started. Defaults to RETRY_TIMEOUT.
+
+        Raises:
+            TooManyInstancesError: the project already has more than HARD_LIMIT_MAX_INSTANCES instances.
+            RemoteExecutionError: the job script could not be run.
+
+        Returns:
+            bytes: Stdout of the job, only the last MAX_OUTPUT_LINES lines (see ssh_client). The full output is logged
+                at debug level while the job runs.
+        """
+        keys = prewarm_keys()  # generate the keypair while we look up the image and the instances
+        this_instance = Instance(job.job_name, self.project, self.zone)
+        # the instance might exist already (e.g. created by fire_many): everything that can fail has to be covered by
+        # the cleanup
         try:
+            image_link, instances, existing = self.get_job_resources(self.project, job.image_name, job.job_name)
+
+            # the key goes into the insert metadata, so a new instance needs no setMetadata in add_ssh_keys
+            builder = self.spec_builder(job, image_link, public_key=keys.result()[1])
+
+            if instances is not None:
+                logger.debug("Instances in zone %s:", self.zone)
+                for instance in instances:
+                    logger.debug(" - %s (%s)", instance["name"], instance["zone"].rsplit("/", 1)[-1])
+
+            # a stopped instance is started again, so it counts towards the limit like a new one
+            stopped = existing is not None and existing.get("status") == "TERMINATED"
+            if (existing is None or stopped) and instances is not None and len(instances) > HARD_LIMIT_MAX_INSTANCES:
+                raise TooManyInstancesError
+
+            if stopped:
+                # e.g. a preempted instance of an earlier run: the insert would fail on the duplicate name
+                logger.info("Starting stopped Instance %s.", builder.name)
+                # the metadata can be changed while it is stopped, so our key is there once sshd comes up
+                self.add_ssh_keys(this_instance, instance_data=existing, keypair=keys.result())
+                self.start_instance(this_instance)
+                # a stopped instance gets a new ephemeral ip when it is started
+                self.get_instance_data(this_instance, fields=INSTANCE_IP_FIELDS)
+            elif existing is not None:
+                # e.g. we crashed before the cleanup: attach to the instance instead of failing on a duplicate insert
+                logger.info("Reusing existing Instance %s.", builder.name)
+                # we need the metadata to check if our key is on the instance and add it otherwise
+                self.set_instance_data(this_instance, existing)
+                self.add_ssh_keys(this_instance, instance_data=existing, keypair=keys.result())
+            else:
+                # we could return the instance right here, but for now we will populate the instances directly from
+                # the API so we know it really exists. As of now, there is no real benefit of tracking instance states
+                # also in gcpfire because we will throw away the instance anyway after executing the next few lines.
+                self.create_instance(builder)
+                # our key came with the insert, so all we still need is the ip
+                self.get_instance_data(this_instance, fields=INSTANCE_IP_FIELDS)
+                self.attach_private_key(this_instance, keys.result()[0])
+
             return this_instance.remote_execute_script(
-                script_path=job.job_script_path, retry_wait=retry_wait, max_retry=max_retry
+                script_path=job.job_script_path, retry_wait=retry_wait, max_retry=max_retry, timeout=timeout
             )
         except Exception as e:
             raise e  # capture all errors and re-raise, so we can guarantee the finally is executed no matter which exception happens
         finally:
-            self.cleanup(this_instance, wait)
+            self.cleanup(this_instance, wait, job.wait_for_delete)
+
+    async def fire_async(self, job: JobSpec, executor: Optional[ThreadPoolExecutor] = None, **kwargs: Any) -> bytes:
+        """fire() for callers that already run an event loop. The blocking API client and ssh run in a worker thread,
+        so the loop can drive many jobs at once (e.g. with asyncio.gather).
+
+        Args:
+            job (JobSpec): job to execute.
+            executor (Optional[ThreadPoolExecutor], optional): executor to run in. Defaults to the loop's default.
+            **kwargs: passed on to fire().
+
+        Returns:
+            bytes: Stdout of the job.
+        """
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(executor, partial(self.fire, job, **kwargs))
+
+    async def _fire_one(
+        self,
+        job: JobSpec,
+        semaphore: asyncio.Semaphore,
+        executor: ThreadPoolExecutor,
+        started: Set[str],
+        **kwargs: Any,
+    ) -> bytes:
+        def run() -> bytes:
+            # only mark the job once fire() runs: from here on it owns the instance and its cleanup, even if the task
+            # is cancelled before the worker picks it up
+            started.add(job.job_name)
+            return self.fire(job, **kwargs)
+
+        async with semaphore:
+            return await asyncio.get_running_loop().run_in_executor(executor, run)
+
+    def fire_many(
+        self,
+        jobs: List[JobSpec],
+        wait: bool = False,
+        retry_wait: float = 0.5,
+        max_retry: int = 20,
+        max_concurrent: int = HARD_LIMIT_MAX_INSTANCES,
+        timeout: float = RETRY_TIMEOUT,
+    ) -> List[bytes]:
+        """Fire several jobs concurrently. At most `max_concurrent` instances are in flight at the same time,
+        so the waiting for GCP operations and ssh of the different jobs overlaps instead of adding up.
+
+        Args:
+            jobs (List[JobSpec]): jobs to execute. Job names have to be unique.
+            wait (bool, optional): Ask for confirmation before deleting each instance. Defaults to False.
+            retry_wait (float, optional): Seconds to wait before the first ssh retry (backs off from there). Defaults
+                to 0.5.
+            max_retry (int, optional): Retry the ssh connection test if it fails. Defaults to 20.
+            max_concurrent (int, optional): Jobs in flight at the same time, never more than HARD_LIMIT_MAX_INSTANCES.
+                Defaults to HARD_LIMIT_MAX_INSTANCES.
+            timeout (float, optional): Seconds after which no further ssh retry is started, per job. Defaults to
+                RETRY_TIMEOUT.
+
+        Returns:
+            List[bytes]: Stdout of every job, in the same order as `jobs`.
+        """
+        concurrency = max(min(max_concurrent, HARD_LIMIT_MAX_INSTANCES), 1)
+        started: Set[str] = set()
+
+        async def fire_all() -> List[bytes]:
+            semaphore = asyncio.Semaphore(concurrency)
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                return await asyncio.gather(
+                    *[
+                        self._fire_one(
+                            job,
+                            semaphore,
+                            executor,
+                            started,
+                            wait=wait,
+                            retry_wait=retry_wait,
+                            max_retry=max_retry,
+                            timeout=timeout,
+                        )
+                        for job in jobs
+                    ]
+                )
+
+        self.operation_tracker = OperationTracker(self.compute, self.project, self.zone)
+        created: List[JobSpec] = []
+        try:
+            keys = prewarm_keys()  # all jobs share the cached keypair: generate it while we list the instances
+            # gather starts the jobs in order, so the first `concurrency` jobs are the ones getting the semaphore first
+            created = self._create_all(jobs[:concurrency], keys)
+            return asyncio.run(fire_all())
+        finally:
+            # a failing job cancels the jobs still waiting for the semaphore: their instances were never used
+            for job in created:
+                if job.job_name not in started:
+                    try:
+                        self.cleanup(Instance(job.job_name, self.project, self.zone), False, job.wait_for_delete)
+                    except Exception as e:
+                        # keep cleaning up the others, and don't replace the error of the failed job
+                        logger.error(f"Could not delete Instance {job.job_name}, please delete it manually: {e}")
+            self.operation_tracker = None
+
+    def _create_all(self, jobs: List[JobSpec], keys: Future[Tuple[bytes, bytes]]) -> List[JobSpec]:
+        """Create the instances of the given jobs upfront in one batch if they fit into our instance limit. fire() then
+        finds the instance of its job already existing and skips the insert. Otherwise (or if the batch fails) every
+        job creates its own instance as before.
+
+        Returns:
+            List[JobSpec]: jobs whose instance might have been created (a failed batch can still create some), so the
+            caller has to clean them up if the job never runs.
+        """
+        instances = self.list_instances()
+        if (len(instances) if instances is not None else 0) + len(jobs) > HARD_LIMIT_MAX_INSTANCES:
+            return []
+
+        image_links = {
+            family: self.get_image_link(self.project, family) for family in {job.image_name for job in jobs}
+        }
+        try:
+            public_key = keys.result()[1]
+            self.create_instances([self.spec_builder(job, image_links[job.image_name], public_key) for job in jobs])
+        except Exception as e:
+            logger.warning("Creating all instances at once failed, creating them one by one: %s", e)
+        return jobs
 
 
 class InstanceNotExistsError(Exception):
@@ -215,3 +783,17 @@ class NoResourcesError(Exception):
     """Raised when GCP has no Resources to fulfil our request."""
 
     pass
+
+
+class QuotaExceededError(Exception):
+    """Raised when the request would exceed a quota of the Project."""
+
+    pass
+
+
+# Compute Engine error codes we map to our own exceptions.
+_ERR_MAP: Dict[str, Type[Exception]] = {
+    "ZONE_RESOURCE_POOL_EXHAUSTED": NoResourcesError,
+    "ZONE_RESOURCE_POOL_EXHAUSTED_WITH_DETAILS": NoResourcesError,
+    "QUOTA_EXCEEDED": QuotaExceededError,
+}
@@ -0,0 +1,50 @@
+"""On-disk cache for Google API discovery documents"""
+import hashlib
+import os
+import time
+from typing import Optional
+
+from googleapiclient.discovery_cache.base import Cache
+
+from gcpfire.logger import logger
+
+DISCOVERY_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gcpfire", "discovery")
+DISCOVERY_CACHE_TTL = 7 * 24 * 3600  # seconds
+
+
+class DiscoveryCache(Cache):  # type: ignore[misc]
+    """Stores discovery documents as files so we only download them once instead of on every client build. The
+    default cache of googleapiclient needs oauth2client<4, which is why we bring our own. Documents older than `ttl`
+    seconds are downloaded again, so we pick up changes of the API eventually.
+    """
+
+    def __init__(self, cache_dir: str = DISCOVERY_CACHE_DIR, ttl: int = DISCOVERY_CACHE_TTL) -> None:
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def _path(self, url: str) -> str:
+        return os.path.join(self.cache_dir, hashlib.sha1(url.encode()).hexdigest() + ".json")
+
+    def get(self, url: str) -> Optional[str]:
+        path = self._path(url)
+        try:
+            if time.time() - os.path.getmtime(path) > self.ttl:
+                logger.debug("Cached discovery document for %s expired.", url)
+                return None
+            with open(path, "r") as cache_file:
+                logger.debug("Using cached discovery document for %s", url)
+                return cache_file.read()
+        except OSError:
+            return None
+
+    def set(self, url: str, content: str) -> None:
+        path = self._path(url)
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            # write to a temporary file first, so concurrent readers never see a half-written document
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as cache_file:
+                cache_file.write(content)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            logger.warning(f"Could not cache discovery document: {e}")
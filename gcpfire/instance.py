@@ -1,45 +1,157 @@
 from __future__ import annotations
 
+import asyncio
+import base64
+import gzip
 import os
+import random
 import time
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache, partial
+from pathlib import Path
 from typing import Any, Dict, List, Optional
 
 from gcpfire import ssh_client as ssh
 from gcpfire.keys import delete_key_file
 from gcpfire.logger import logger
 
+RETRY_BASE_WAIT = 0.5  # seconds before the first ssh retry
+MAX_RETRY_WAIT = 10  # cap of a single backoff
+RETRY_TIMEOUT = 120  # seconds we wait for sshd of a new instance to accept our key
+STARTUP_SCRIPT_COMPRESS_THRESHOLD = 4096  # bytes
+
+
+@lru_cache(maxsize=32)
+def _read_script(path: str, mtime_ns: int) -> str:
+    return Path(path).read_text()
+
+
+def _load_script(path: str) -> str:
+    """Read a (startup) script once; builders applied to several zones reuse the content. The cache is keyed on the
+    modification time too, so an edited script is picked up without restarting the process.
+    """
+    return _read_script(path, os.stat(path).st_mtime_ns)
+
+
+def _compress_script(script: str) -> str:
+    """Wrap a script into a much smaller one that unpacks (base64 + gzip) the original to a temporary file and runs it
+    with the interpreter of its shebang (bash if it has none), like GCE would have. Keeps big startup scripts from
+    bloating the metadata we send with every insert.
+    """
+    compressed = gzip.compress(script.encode(), compresslevel=6, mtime=0)
+    run = '"$f"' if script.startswith("#!") else 'bash "$f"'
+    return (
+        "#!/bin/bash\nf=$(mktemp)\nbase64 -d <<'EOF' | gunzip > \"$f\"\n"
+        + base64.b64encode(compressed).decode()
+        + f'\nEOF\nchmod +x "$f"\n{run}\nrc=$?\nrm -f "$f"\nexit $rc\n'
+    )
+
+
+@lru_cache(maxsize=32)
+def _machine_type_url(zone: str, machine_type: str) -> str:
+    return "zones/%s/machineTypes/%s" % (zone, machine_type)
+
+
+@lru_cache(maxsize=32)
+def _accelerator_url(project: str, zone: str, label: str) -> str:
+    return "projects/%s/zones/%s/acceleratorTypes/%s" % (project, zone, label)
+
+
+@lru_cache(maxsize=8)
+def _config_template(
+    image_link: str, preemptible: bool, disk_size_gb: int, source_snapshot: Optional[str]
+) -> Dict[str, Any]:
+    """The part of the instance config that is the same for every job of a batch (scheduling, boot disk, network and
+    service account). Built once per image, disk and scheduling; callers must not mutate it.
+    """
+    # A snapshot of an already booted disk skips the first-boot initialization of the image.
+    source = {"sourceSnapshot": source_snapshot} if source_snapshot is not None else {"sourceImage": image_link}
+    return {
+        "scheduling": {
+            "preemptible": preemptible,
+            "onHostMaintenance": "TERMINATE",
+            "automaticRestart": False,
+        },
+        # Specfiy the boot disk and the image to use asa source
+        "disks": [
+            {
+                "boot": True,
+                "autoDelete": True,
+                "initializeParams": {"diskSizeGb": str(disk_size_gb), **source},
+            }
+        ],
+        # Specify Network Interface with NAT to accesss the public internet
+        "networkInterfaces": [
+            {
+                "network": "global/networks/default",
+                "accessConfigs": [{"type": "ONE_TO_ONE_NAT", "name": "External NAT"}],
+            }
+        ],
+        # Allow Instance to access cloud storage and logging
+        "serviceAccounts": [
+            {
+                # "email": "gcpfire-worker@main-composite-287415.iam.gserviceaccount.com",
+                "email": "default",
+                "scopes": [
+                    "https://www.googleapis.com/auth/devstorage.read_write",
+                    "https://www.googleapis.com/auth/logging.write",
+                    "https://www.googleapis.com/auth/datastore",
+                    "https://www.googleapis.com/auth/monitoring.write",
+                    "https://www.googleapis.com/auth/service.management.readonly",
+                    "https://www.googleapis.com/auth/servicecontrol",
+                    "https://www.googleapis.com/auth/trace.append",
+                ],
+            }
+        ],
+    }
+
 
 class Instance:
     """Define a new Instance."""
 
-    external_ip: Optional[str] = None
-    private_key_file: Optional[str] = None
+    __slots__ = ("name", "project", "zone", "external_ip", "private_key_file", "metadata")
 
     def __init__(self, name: str, project: str, zone: str) -> None:
         self.name = name
         self.project = project
         self.zone = zone
+        self.external_ip: Optional[str] = None
+        self.private_key_file: Optional[str] = None
+        self.metadata: Optional[Dict[str, Any]] = None  # incl. the fingerprint needed for setMetadata
 
     def delete_local_keyfile(self) -> None:
         if self.private_key_file is not None:
             delete_key_file(self.private_key_file)
             self.private_key_file = None
 
-    def remote_execute_script(self, script_path: str, retry_wait: int = 5, max_retry: int = 5) -> List[bytes]:
+    def remote_execute_script(
+        self,
+        script_path: str,
+        retry_wait: float = RETRY_BASE_WAIT,
+        max_retry: int = 20,
+        timeout: float = RETRY_TIMEOUT,
+    ) -> bytes:
         """Remotely execute code over SSH. Raises Exception if SSH command failed, otherwise returns the stdout or an
-           empty list.
+           empty list. Only the connection test is retried until the instance accepts our key: the script is copied
+           and run once, since a job is not necessarily safe to run twice.
 
         Args:
             script_path (str): path to a bash script we want to remotely execute.
-            retry_wait (int, optional): Seconds to wait between retries. Defaults to 5.
-            max_retry (int, optional): Retry ssh commands if they fail. Defaults to 5.
+            retry_wait (float, optional): Seconds to wait before the first retry. Doubles with every retry, capped at
+                MAX_RETRY_WAIT, and is jittered by +-50% so many instances do not probe in lockstep. Defaults to
+                RETRY_BASE_WAIT.
+            max_retry (int, optional): Retry the connection test if it fails. Defaults to 20.
+            timeout (float, optional): Seconds after which no further retry is started, no matter how many are left.
+                Defaults to RETRY_TIMEOUT.
 
         Raises:
             ValueError: path to private key file is empty.
-            RemoteExecutionError: Raised if execution failed after #retries. Attaches stderr.
+            RemoteExecutionError: Raised if the connection could not be established after #retries, or copying or
+                running the script failed. Attaches stderr.
 
         Returns:
-            List[bytes]: Stdout (if any). Will be empty for ssh copy.
+            bytes: Stdout (empty if there is none), only the last ssh.MAX_OUTPUT_LINES lines. The full output is
+                logged at debug level while the script runs.
         """
         assert self.external_ip is not None
 
@@ -56,25 +168,82 @@ class Instance:
 
         # For some reason the connection does not work on the first try. Maybe because google only adds the key to
         # authorized_keys during the first connection attempt. So we just keep probing the connection a couple times.
-        for _ in range(max_retry):
-            try:
-                # Test connection to trigger a retry if the ssh key is not ready on the remote.
-                ssh.test_connection(self.external_ip, key)
+        try:
+            deadline = time.monotonic() + timeout
+            for attempt in range(max_retry):
+                try:
+                    # Cheap check if sshd is up at all, before we pay for a full ssh handshake.
+                    if not ssh.port_open(self.external_ip):
+                        raise ssh.ShellExecutionError(f"Port 22 on {self.external_ip} is not reachable (yet).")
 
-                # Otherwise we can continue (but we can still get a ssh.RemoteExecutionError with the next commands)
-                # Ok it worked, we can now upload a bash file and execute it.
+                    # Test connection to trigger a retry if the ssh key is not ready on the remote.
+                    ssh.test_connection(self.external_ip, key)
+                    break
+                except ssh.ShellExecutionError as e:
+                    err = e
+                    # if we had an error we will wait and skip ahead to next iteration
+                    delay = min(retry_wait * 2 ** attempt, MAX_RETRY_WAIT) * random.uniform(0.5, 1.5)
+                    if time.monotonic() + delay > deadline:
+                        raise RemoteExecutionError(err.message, err.stderror)
+                    time.sleep(delay)
+            else:
+                # we exhausted our # of tries and will propagate stderr
+                raise RemoteExecutionError(err.message, err.stderror)
+
+            # Ok it worked, we can now upload a bash file and execute it. Both only once: a failure here is not the
+            # instance coming up, and the job might not be safe to run twice.
+            try:
                 ssh.ssh_copy_file(self.external_ip, script_path, key)
 
-                # We need full login-shell (`bash -l`) or otherwise Compute Engine login agent will not automatically grant
-                # us the access scopes from the service account and we cannot access the Container Registry
+                # We need full login-shell (`bash -l`) or otherwise Compute Engine login agent will not
+                # automatically grant us the access scopes from the service account and we cannot access the
+                # Container Registry
                 return ssh.ssh_run_command(self.external_ip, f"bash -l {os.path.basename(script_path)}", key)
             except ssh.ShellExecutionError as e:
-                err = e
-                # if we had an error we will wait and skip ahead to next iteration
-                time.sleep(retry_wait)
-                continue
-        else:  # loop did not exit early (no break) --> we exhausted our # of tries and will propagate stderr
-            raise RemoteExecutionError(err.message, err.stderror)
+                raise RemoteExecutionError(e.message, e.stderror)
+        finally:
+            # all ssh/scp calls above share one master connection (see ssh.ssh_options), we are done with it now
+            ssh.close_master(self.external_ip)
+
+
+def run_many(
+    instances: List[Instance],
+    script_path: str,
+    retry_wait: float = RETRY_BASE_WAIT,
+    max_retry: int = 20,
+    timeout: float = RETRY_TIMEOUT,
+) -> List[bytes]:
+    """Execute the same script on several instances at once, so the ssh bring-up (and retries) of the instances overlap
+    instead of adding up.
+
+    Args:
+        instances (List[Instance]): instances with external ip and private key file.
+        script_path (str): path to a bash script we want to remotely execute.
+        retry_wait (float, optional): Seconds to wait before the first retry. Defaults to RETRY_BASE_WAIT.
+        max_retry (int, optional): Retry the ssh connection test if it fails. Defaults to 20.
+        timeout (float, optional): Seconds after which no further ssh retry is started. Defaults to RETRY_TIMEOUT.
+
+    Raises:
+        RemoteExecutionError: Raised if execution failed on any of the instances.
+
+    Returns:
+        List[bytes]: Stdout of every instance, in the same order as `instances`.
+    """
+
+    async def run_all() -> List[bytes]:
+        loop = asyncio.get_running_loop()
+        # the ssh client runs in a subprocess, so threads are all we need to wait on many of them at once
+        with ThreadPoolExecutor(max_workers=max(len(instances), 1)) as executor:
+            return await asyncio.gather(
+                *[
+                    loop.run_in_executor(
+                        executor, partial(instance.remote_execute_script, script_path, retry_wait, max_retry, timeout)
+                    )
+                    for instance in instances
+                ]
+            )
+
+    return asyncio.run(run_all())
 
 
 class RemoteExecutionError(ssh.ShellExecutionError):
@@ -87,63 +256,55 @@ class InstanceSpecBuilder:
     compute api instance is attached to.
     """
 
-    serial_port_enable = False
-    oslogin_enable = False
-
     def __init__(
         self,
         name: str,
         image_link: str,
         additional_meta: List[Dict[str, Any]],
         machine_type: str,
-        accelerators: Dict[str, int] = {},
+        accelerators: Optional[Dict[str, int]] = None,
         preemptible: bool = True,
         startup_script_path: Optional[str] = None,
+        serial_port_enable: bool = False,
+        oslogin_enable: bool = False,
+        ssh_keys: Optional[str] = None,
+        disk_size_gb: int = 50,
+        source_snapshot: Optional[str] = None,
     ) -> None:
         self.name = name
         self.additional_meta = additional_meta
         self.image_link = image_link
         self.machine_type = machine_type
-        self.gpus = accelerators
+        self.gpus = accelerators or {}
         self.preemptible = preemptible
         self.startup_script_path = startup_script_path
+        self.serial_port_enable = serial_port_enable
+        self.oslogin_enable = oslogin_enable
+        self.ssh_keys = ssh_keys  # "user:public key" lines, so the instance boots with our key already authorized
+        self.disk_size_gb = disk_size_gb  # smaller boot disks are initialized faster
+        self.source_snapshot = source_snapshot  # boot disk from a snapshot instead of image_link
+        self._static_config = self._build_static_config()
 
-    def build(self, project: str, zone: str) -> InstanceSpecBuilder:
-        """Finalizes the spec with PROJECT and ZONE information and builds the config."""
-        logger.debug(
-            (
-                f"Creating Instance {self.name} with machine_type={self.machine_type}, preemptible={self.preemptible}, "
-                f"gpus={self.gpus}, startup_script={self.startup_script_path}, metadata={self.additional_meta}"
-            )
-        )
-        if self.preemptible:
-            logger.debug("This instance is pre-emptible and will live for no longer than 24 hours.")
-
-        # Image
-        source_disk_image = self.image_link
-
-        # Configure the Machine
-        machine_type = "zones/%s/machineTypes/%s" % (zone, self.machine_type)
-
-        # Configure the Accelerators
-        guest_accelerators = []
-        if len(self.gpus) > 0:
-            for label, count in self.gpus.items():
-                accelerator_type = "projects/%s/zones/%s/acceleratorTypes/%s" % (
-                    project,
-                    zone,
-                    label,
-                )
-                guest_accelerators.append({"acceleratorCount": count, "acceleratorType": accelerator_type})
-
+    def _build_static_config(self) -> Dict[str, Any]:
+        """Everything of the config that does not depend on PROJECT and ZONE, so we only assemble it once."""
         meta_items = [
             {"key": "serial-port-enable", "value": self.serial_port_enable},
             {"key": "enable-oslogin", "value": self.oslogin_enable},
-            *self.additional_meta,
         ]
+        meta_items.extend(item for item in self.additional_meta if item["key"] != "ssh-keys")
+        # GCE only reads one "ssh-keys" item, so our key is added to the keys of the job instead of shadowing them
+        ssh_keys = [item["value"] for item in self.additional_meta if item["key"] == "ssh-keys"]
+        if self.ssh_keys is not None:
+            ssh_keys.append(self.ssh_keys)
+        if len(ssh_keys) > 0:
+            meta_items.append({"key": "ssh-keys", "value": "\n".join(ssh_keys)})
 
         if self.startup_script_path is not None:
-            startup_script = open(self.startup_script_path, "r").read()
+            startup_script = _load_script(self.startup_script_path)
+            size = len(startup_script.encode())  # the metadata limit counts bytes, not characters
+            if size > STARTUP_SCRIPT_COMPRESS_THRESHOLD:
+                logger.debug("Compressing startup script (%d bytes).", size)
+                startup_script = _compress_script(startup_script)
             meta_items.append(
                 # Automatically install the driver after start-up
                 # (not needed for us since we have it already installed in the disk image)
@@ -156,51 +317,44 @@ class InstanceSpecBuilder:
                 }
             )
 
-        self.config = {
+        # The template is shared between builders, so it is merged shallowly and never mutated.
+        return {
             "name": self.name,
-            "machineType": machine_type,
-            "scheduling": {
-                "preemptible": self.preemptible,
-                "onHostMaintenance": "TERMINATE",
-                "automaticRestart": False,
-            },
-            # Specfiy the boot disk and the image to use asa source
-            "disks": [
-                {
-                    "boot": True,
-                    "autoDelete": True,
-                    "diskSizeGb": "50",
-                    "initializeParams": {"sourceImage": source_disk_image},
-                }
-            ],
-            # Specify Network Interface with NAT to accesss the public internet
-            "networkInterfaces": [
-                {
-                    "network": "global/networks/default",
-                    "accessConfigs": [{"type": "ONE_TO_ONE_NAT", "name": "External NAT"}],
-                }
-            ],
-            # Accelerators (GPU/TPU)
-            "guestAccelerators": guest_accelerators,
-            # Allow Instance to access cloud storage and logging
-            "serviceAccounts": [
-                {
-                    # "email": "gcpfire-worker@main-composite-287415.iam.gserviceaccount.com",
-                    "email": "default",
-                    "scopes": [
-                        "https://www.googleapis.com/auth/devstorage.read_write",
-                        "https://www.googleapis.com/auth/logging.write",
-                        "https://www.googleapis.com/auth/datastore",
-                        "https://www.googleapis.com/auth/monitoring.write",
-                        "https://www.googleapis.com/auth/service.management.readonly",
-                        "https://www.googleapis.com/auth/servicecontrol",
-                        "https://www.googleapis.com/auth/trace.append",
-                    ],
-                }
-            ],
+            **_config_template(self.image_link, self.preemptible, self.disk_size_gb, self.source_snapshot),
             # Metadata is readable from the instance and allows you to pass
             # configuration from deployment scripts to instance
             "metadata": {"items": meta_items},
         }
 
+    def build(self, project: str, zone: str) -> InstanceSpecBuilder:
+        """Finalizes the spec with PROJECT and ZONE information and builds the config."""
+        logger.debug(
+            "Creating Instance %s with machine_type=%s, preemptible=%s, gpus=%s, startup_script=%s, metadata=%s",
+            self.name,
+            self.machine_type,
+            self.preemptible,
+            self.gpus,
+            self.startup_script_path,
+            self.additional_meta,
+        )
+        if self.preemptible:
+            logger.debug("This instance is pre-emptible and will live for no longer than 24 hours.")
+
+        # Configure the Machine
+        machine_type = _machine_type_url(zone, self.machine_type)
+
+        # Configure the Accelerators
+        guest_accelerators = [
+            {"acceleratorCount": count, "acceleratorType": _accelerator_url(project, zone, label)}
+            for label, count in self.gpus.items()
+        ]
+
+        # Only the zone dependent keys are new, so a shallow copy of the static part is enough.
+        self.config = {
+            **self._static_config,
+            "machineType": machine_type,
+            # Accelerators (GPU/TPU)
+            "guestAccelerators": guest_accelerators,
+        }
+
         return self
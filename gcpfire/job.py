@@ -4,7 +4,11 @@ from typing import Any, Dict, List, Optional
 
 @dataclass
 class JobSpec:
-    """The externally accessible abstraction for Jobs we execute on GCP."""
+    """The externally accessible abstraction for Jobs we execute on GCP.
+
+    The job_name becomes the instance name, so it has to be unique among the jobs in flight (e.g. add a
+    uuid.uuid4().hex[:8] suffix): a job whose instance already exists in the zone attaches to that instance.
+    """
 
     job_name: str
     job_script_path: str
@@ -14,3 +18,6 @@ class JobSpec:
     preemptible: bool = True
     additional_meta: List[Dict[str, Any]] = field(default_factory=list)
     startup_script_path: Optional[str] = None
+    disk_size_gb: int = 50
+    source_snapshot: Optional[str] = None  # e.g. from ComputeAPI.snapshot_boot_disk(), used instead of the image
+    wait_for_delete: bool = False  # block fire() until the instance is deleted
@@ -1,23 +1,56 @@
 """generate key pair"""
+from __future__ import annotations
 
+import hashlib
 import os
-from typing import Optional, Tuple
+import threading
+import time
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Optional, Tuple, Union
 
 from cryptography.hazmat.backends import default_backend as crypto_default_backend
 from cryptography.hazmat.primitives import serialization as crypto_serialization
 from cryptography.hazmat.primitives.asymmetric import rsa
+from cryptography.hazmat.primitives.asymmetric.ed25519 import Ed25519PrivateKey
 
 from gcpfire.logger import logger
 
+KEY_CACHE_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gcpfire", "keys")
+KEY_CACHE_TTL = 3600  # seconds
 
-def generate_keypair(username: str = "gcpfire") -> Tuple[bytes, bytes]:
-    logger.debug("Generating key pair.")
-    key = rsa.generate_private_key(
-        backend=crypto_default_backend(), public_exponent=65537, key_size=2048  # type: ignore
-    )
+_keypair_cache: Dict[str, Tuple[float, bytes, bytes]] = {}
+_keypair_lock = threading.Lock()
+
+
+def generate_keypair(username: str = "gcpfire", algorithm: str = "ed25519") -> Tuple[bytes, bytes]:
+    """Generate a ssh keypair. Ed25519 keys are generated orders of magnitude faster than RSA keys, so they are the
+    default. Use algorithm="rsa" for environments that do not accept Ed25519.
+
+    Args:
+        username (str, optional): appended to the public key as comment. Defaults to "gcpfire".
+        algorithm (str, optional): "ed25519" or "rsa" (2048 bit). Defaults to "ed25519".
+
+    Raises:
+        ValueError: unknown algorithm.
+
+    Returns:
+        Tuple[bytes, bytes]: private key (PEM) and public key (OpenSSH format)
+    """
+    logger.debug("Generating %s key pair.", algorithm)
+    key: Union[Ed25519PrivateKey, rsa.RSAPrivateKey]
+    if algorithm == "ed25519":
+        key = Ed25519PrivateKey.generate()
+        private_format = crypto_serialization.PrivateFormat.OpenSSH
+    elif algorithm == "rsa":
+        key = rsa.generate_private_key(
+            backend=crypto_default_backend(), public_exponent=65537, key_size=2048  # type: ignore
+        )
+        private_format = crypto_serialization.PrivateFormat.TraditionalOpenSSL
+    else:
+        raise ValueError(f"Unknown key algorithm: {algorithm}")
     private_key = key.private_bytes(
         crypto_serialization.Encoding.PEM,
-        crypto_serialization.PrivateFormat.TraditionalOpenSSL,
+        private_format,
         crypto_serialization.NoEncryption(),
     )
     public_key = key.public_key().public_bytes(
@@ -28,18 +61,99 @@ def generate_keypair(username: str = "gcpfire") -> Tuple[bytes, bytes]:
     return (private_key, public_key)
 
 
-def write_pubkey(key: bytes, name: Optional[str] = None, outpath: str = os.getcwd()) -> str:
+def _write_file_atomic(path: str, content: bytes, mode: int) -> None:
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+    with os.fdopen(fd, "wb") as tmp_file:
+        tmp_file.write(content)
+    os.replace(tmp_path, path)
+
+
+def generate_keypair_cached(
+    username: str = "gcpfire", algorithm: str = "ed25519", cache_dir: str = KEY_CACHE_DIR, ttl: int = KEY_CACHE_TTL
+) -> Tuple[bytes, bytes]:
+    """Same as generate_keypair(), but reuses a keypair that is younger than `ttl` seconds. Looks in memory first and
+    then on disk, so also a new process does not have to pay for the key generation (slow for RSA).
+
+    Args:
+        username (str, optional): user the public key is issued for. Defaults to "gcpfire".
+        algorithm (str, optional): "ed25519" or "rsa". Defaults to "ed25519".
+        cache_dir (str, optional): directory for the cached keys. Defaults to KEY_CACHE_DIR.
+        ttl (int, optional): Seconds a keypair is reused. Defaults to KEY_CACHE_TTL.
+
+    Returns:
+        Tuple[bytes, bytes]: private and public key
+    """
+    name = hashlib.sha1(f"{username}:{algorithm}".encode()).hexdigest()
+    private_path = os.path.join(cache_dir, name)
+    public_path = private_path + ".pub"
+
+    with _keypair_lock:
+        cached = _keypair_cache.get(private_path)
+        if cached is not None and time.time() - cached[0] < ttl:
+            return cached[1], cached[2]
+
+        try:
+            created = os.path.getmtime(private_path)
+            if time.time() - created < ttl:
+                with open(private_path, "rb") as private_file, open(public_path, "rb") as public_file:
+                    private_key, public_key = private_file.read(), public_file.read()
+                logger.debug("Using cached key pair %s.", private_path)
+                _keypair_cache[private_path] = (created, private_key, public_key)
+                return private_key, public_key
+        except OSError:
+            pass  # not cached yet
+
+        private_key, public_key = generate_keypair(username, algorithm)
+        try:
+            os.makedirs(cache_dir, mode=0o700, exist_ok=True)
+            _write_file_atomic(public_path, public_key, 0o644)
+            _write_file_atomic(private_path, private_key, 0o600)  # written last: its mtime marks the pair as valid
+        except OSError as e:
+            logger.warning(f"Could not cache key pair: {e}")
+        _keypair_cache[private_path] = (time.time(), private_key, public_key)
+        return private_key, public_key
+
+
+def prewarm_keys(username: str = "gcpfire") -> Future[Tuple[bytes, bytes]]:
+    """Fill the keypair cache in a background thread, e.g. while we wait for the instance to be created.
+
+    Returns:
+        Future[Tuple[bytes, bytes]]: resolves to the (private key, public key) tuple.
+    """
+    executor = ThreadPoolExecutor(max_workers=1)
+    future = executor.submit(generate_keypair_cached, username)
+    executor.shutdown(wait=False)
+    return future
+
+
+def _write_file_exclusive(path: str, content: bytes, mode: int) -> None:
+    """Create the file with its final mode in a single open, so it is never readable by others. A stale file from an
+    earlier run is removed first, because O_EXCL refuses to open an existing file.
+    """
+    os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | os.O_EXCL, mode)
+    with os.fdopen(fd, "wb") as key_file:
+        key_file.write(content)
+
+
+def write_pubkey(key: bytes, name: Optional[str] = None, outpath: Optional[str] = None) -> str:
+    if outpath is None:
+        outpath = os.getcwd()
     pubkey_name = os.path.join(outpath, name + ".key" if name is not None else "public.key")
-    with open(pubkey_name, "wb") as pubkey_file:
-        pubkey_file.write(key)
+    _write_file_exclusive(pubkey_name, key, 0o644)
     return pubkey_name
 
 
-def write_privatekey(key: bytes, name: Optional[str] = None, outpath: str = os.getcwd()) -> str:
+def write_privatekey(key: bytes, name: Optional[str] = None, outpath: Optional[str] = None) -> str:
+    if outpath is None:
+        outpath = os.getcwd()
     pkey_name = os.path.join(outpath, name + "_private.key" if name is not None else "private.key")
-    with open(pkey_name, "wb") as pkey_file:  # TODO: os.makedirs
-        os.chmod(pkey_name, 0o600)
-        pkey_file.write(key)
+    _write_file_exclusive(pkey_name, key, 0o600)
     return pkey_name
 
 
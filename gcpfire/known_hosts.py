@@ -0,0 +1,140 @@
+"""Remove hosts from ~/.ssh/known_hosts without shelling out to ssh-keygen"""
+import atexit
+import base64
+import hashlib
+import hmac
+import os
+import threading
+from typing import List, Optional, Set, Tuple
+
+from gcpfire.logger import logger
+
+KNOWN_HOSTS_FILE = os.path.join(os.path.expanduser("~"), ".ssh", "known_hosts")
+HASHED_MAGIC = "|1|"
+
+
+def _hostnames(line: str) -> List[str]:
+    """Hostnames of a known_hosts line (empty for comments and blank lines)."""
+    fields = line.split()
+    if len(fields) == 0 or fields[0].startswith("#"):
+        return []
+    if fields[0].startswith("@"):  # @cert-authority / @revoked marker
+        fields = fields[1:]
+    return fields[0].split(",") if len(fields) > 0 else []
+
+
+def _plain_host(hostname: str) -> str:
+    """Strip the port of "[host]:port" entries (non-standard port), so a host is removed for every port."""
+    if hostname.startswith("["):
+        return hostname[1:].split("]", 1)[0]
+    return hostname
+
+
+def _parse_hashed(hostname: str) -> Optional[Tuple[bytes, bytes]]:
+    """Salt and digest of a hashed entry ("|1|salt|hash", see HashKnownHosts) or None for plain entries."""
+    if not hostname.startswith(HASHED_MAGIC):
+        return None
+    try:
+        salt, digest = hostname[len(HASHED_MAGIC) :].split("|", 1)
+        return base64.b64decode(salt), base64.b64decode(digest)
+    except ValueError:
+        return None
+
+
+def _hash_matches(hashed: Tuple[bytes, bytes], hostname: str) -> bool:
+    salt, digest = hashed
+    return hmac.compare_digest(hmac.new(salt, hostname.encode(), hashlib.sha1).digest(), digest)
+
+
+class KnownHostsCache:
+    """Parses known_hosts once per process into a set of hostnames, so removing a host is a set lookup instead of a
+    fork of ssh-keygen and a scan of the file. The file is only rewritten by flush(), once for all pending removals,
+    and only if a removed host was actually in it. Pending removals are flushed at exit.
+
+    Like `ssh-keygen -R`, entries for the host on any port ("[host]:port") and hashed entries are removed as well.
+    Hashed entries can only be checked with an HMAC per entry, so they are kept apart from the plain hostnames.
+    """
+
+    def __init__(self, path: str = KNOWN_HOSTS_FILE) -> None:
+        self.path = path
+        self._hosts: Optional[Set[str]] = None
+        self._hashed: List[Tuple[bytes, bytes]] = []
+        self._removed: Set[str] = set()
+        self._lock = threading.Lock()
+
+    def _read_lines(self) -> List[str]:
+        try:
+            with open(self.path, "r") as known_hosts_file:
+                return known_hosts_file.readlines()
+        except FileNotFoundError:
+            return []
+
+    def _load(self) -> Set[str]:
+        hosts = set()
+        for line in self._read_lines():
+            for hostname in _hostnames(line):
+                hashed = _parse_hashed(hostname)
+                if hashed is not None:
+                    self._hashed.append(hashed)
+                else:
+                    hosts.add(_plain_host(hostname))
+        return hosts
+
+    def _pop(self, hosts: Set[str], hostname: str) -> bool:
+        """Forget the host (plain or hashed); True if it was known."""
+        if hostname in hosts:
+            hosts.discard(hostname)
+            return True
+        hashed = [entry for entry in self._hashed if _hash_matches(entry, hostname)]
+        for entry in hashed:
+            self._hashed.remove(entry)
+        return len(hashed) > 0
+
+    def remove_host(self, hostname: str) -> bool:
+        """Mark the host for removal.
+
+        Returns:
+            bool: True if the host is in known_hosts, i.e. the file has to be flushed.
+        """
+        with self._lock:
+            if self._hosts is None:
+                self._hosts = self._load()
+            if self._pop(self._hosts, hostname):
+                self._removed.add(hostname)
+                return True
+            return False
+
+    def _keep(self, line: str, removed: Set[str]) -> bool:
+        for hostname in _hostnames(line):
+            hashed = _parse_hashed(hostname)
+            if hashed is not None:
+                if any(_hash_matches(hashed, host) for host in removed):
+                    return False
+            elif _plain_host(hostname) in removed:
+                return False
+        return True
+
+    def flush(self) -> None:
+        """Write known_hosts without the removed hosts. The file is re-read first, so we don't throw away entries
+        other ssh clients added in the meantime.
+        """
+        with self._lock:
+            if len(self._removed) == 0:
+                return
+            lines = self._read_lines()
+            kept = [line for line in lines if self._keep(line, self._removed)]
+            logger.debug("Removing %d entries from %s.", len(lines) - len(kept), self.path)
+            try:
+                mode = os.stat(self.path).st_mode & 0o777
+                tmp_path = f"{self.path}.{os.getpid()}.tmp"
+                fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, mode)
+                with os.fdopen(fd, "w") as tmp_file:
+                    tmp_file.writelines(kept)
+                os.replace(tmp_path, self.path)
+            except OSError as e:
+                logger.warning(f"Could not update {self.path}: {e}")
+            self._removed.clear()
+
+
+known_hosts = KnownHostsCache()
+atexit.register(known_hosts.flush)
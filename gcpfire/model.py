@@ -0,0 +1,29 @@
+"""Faster (de)serialization for the google api client"""
+from typing import Any, Union
+
+import orjson
+from googleapiclient.model import JsonModel
+
+
+class OrjsonModel(JsonModel):  # type: ignore[misc]
+    """JsonModel that parses responses and serializes request bodies with orjson instead of the json module. Matters
+    for the polled operations and the instance lists, which are parsed over and over again, and for insert bodies with
+    big startup scripts.
+    """
+
+    def serialize(self, body_value: Any) -> str:
+        if self._data_wrapper and isinstance(body_value, dict) and "data" not in body_value:
+            body_value = {"data": body_value}
+        body = orjson.dumps(body_value).decode()
+        if not body.isascii():
+            # batch requests compute the content-length from the string length, which only matches the encoded
+            # length for ascii. The json module escapes non-ascii characters, so let it handle those bodies.
+            escaped: str = super().serialize(body_value)
+            return escaped
+        return body
+
+    def deserialize(self, content: Union[str, bytes]) -> Any:
+        body = orjson.loads(content)
+        if self._data_wrapper and isinstance(body, dict) and "data" in body:
+            body = body["data"]
+        return body
@@ -0,0 +1,94 @@
+"""Track many zone operations with a single poller"""
+from __future__ import annotations
+
+import threading
+import time
+from concurrent.futures import Future
+from typing import Any, Dict, Iterator, List, Optional
+
+from googleapiclient.discovery import Resource
+
+from gcpfire.logger import logger
+
+OPERATION_LIST_FIELDS = "items(name,status,error),nextPageToken"
+
+
+class OperationTracker:
+    """Waits for the zone operations of many concurrent jobs. Instead of one request per operation, a background
+    thread lists all pending operations with a single `zoneOperations().list` call per tick and resolves the future of
+    every operation that is DONE. The poll interval starts at `min_interval` and doubles up to `max_interval`; it is
+    reset whenever a new operation is registered, so short operations are noticed quickly.
+    """
+
+    def __init__(
+        self, compute: Resource, project: str, zone: str, min_interval: float = 0.5, max_interval: float = 4
+    ) -> None:
+        self.compute = compute
+        self.project = project
+        self.zone = zone
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self._interval = min_interval
+        self.pending: Dict[str, Future[Dict[str, Any]]] = {}
+        self._lock = threading.Lock()
+        self._thread: Optional[threading.Thread] = None
+
+    def wait_async(self, operation: str) -> Future[Dict[str, Any]]:
+        """Register an operation. The returned future resolves to the operation resource once it is DONE.
+
+        Args:
+            operation (str): name of the zone operation.
+
+        Returns:
+            Future[Dict[str, Any]]: resolves to the DONE operation (which might contain an error).
+        """
+        future: Future[Dict[str, Any]] = Future()
+        with self._lock:
+            self.pending[operation] = future
+            self._interval = self.min_interval
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._poll, name="gcpfire-operation-tracker", daemon=True)
+                self._thread.start()
+        return future
+
+    def _list(self, operations: List[str]) -> Iterator[Any]:
+        request = self.compute.zoneOperations().list(
+            project=self.project,
+            zone=self.zone,
+            filter='name eq "(%s)"' % "|".join(operations),
+            fields=OPERATION_LIST_FIELDS,
+        )
+        while request is not None:
+            result = request.execute()
+            yield from result.get("items", [])
+            request = self.compute.zoneOperations().list_next(request, result)
+
+    def _poll(self) -> None:
+        while True:
+            with self._lock:
+                if len(self.pending) == 0:
+                    self._thread = None  # the next wait_async starts a new poller
+                    return
+                operations = list(self.pending)
+                interval = self._interval
+                self._interval = min(self._interval * 2, self.max_interval)
+
+            logger.debug("Polling %d operations.", len(operations))
+            try:
+                for result in self._list(operations):
+                    if result["status"] == "DONE":
+                        with self._lock:
+                            future = self.pending.pop(result["name"], None)
+                        if future is not None:
+                            future.set_result(result)
+            except Exception as e:
+                # we cannot tell which operation failed, so everybody waiting gets the error
+                with self._lock:
+                    futures = list(self.pending.values())
+                    self.pending.clear()
+                    self._thread = None
+                for future in futures:
+                    future.set_exception(e)
+                return
+
+            time.sleep(interval)
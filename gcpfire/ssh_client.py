@@ -1,14 +1,65 @@
 """Very basic ssh client"""
 import os
+import re
 import shutil
+import socket
 import subprocess
-from typing import List, Optional
+import threading
+from collections import deque
+from functools import lru_cache
+from typing import Deque, List, Optional
 
+from gcpfire.known_hosts import known_hosts
 from gcpfire.logger import logger
 
+# Not in /tmp: other users must not be able to guess or pre-create our master sockets. %C is a hash of user, host and
+# port, so the paths stay short enough for a unix socket.
+CONTROL_DIR = os.path.join(os.path.expanduser("~"), ".cache", "gcpfire", "ssh")
+CONTROL_PATH = os.path.join(CONTROL_DIR, "%C")
+CONTROL_PERSIST = 60  # seconds an idle master connection is kept open
+MAX_OUTPUT_LINES = 1000  # lines of stdout invoke_line() returns
+_WARN_RE = re.compile(rb"^Warning")
 
+
+@lru_cache(maxsize=None)
+def control_path() -> str:
+    """CONTROL_PATH, after making sure its directory exists and only we can access it."""
+    os.makedirs(CONTROL_DIR, mode=0o700, exist_ok=True)
+    os.chmod(CONTROL_DIR, 0o700)  # makedirs does not fix the mode of an existing directory
+    return CONTROL_PATH
+
+
+def ssh_options(keyfile: Optional[str]) -> List[str]:
+    """Common options for ssh and scp. All invocations for the same host share one multiplexed connection
+    (ControlMaster), so only the first one pays for the TCP connect, key exchange and authentication.
+
+    Args:
+        keyfile (Optional[str]): private key for login
+
+    Returns:
+        List[str]: options to put right after the executable.
+    """
+    options = [
+        "-o",
+        "StrictHostKeyChecking=no",
+        "-o",
+        "UserKnownHostsFile=/dev/null",
+        "-o",
+        "ControlMaster=auto",
+        "-o",
+        f"ControlPath={control_path()}",
+        "-o",
+        f"ControlPersist={CONTROL_PERSIST}",
+    ]
+    if keyfile is not None:
+        options.extend(["-i", keyfile])
+    return options
+
+
+@lru_cache(maxsize=None)
 def check_command_exists(executable: str) -> None:
-    """Check if the executable name is present in PATH.
+    """Check if the executable name is present in PATH. Only looked up once per executable, a missing one is looked
+    up again (lru_cache does not cache exceptions).
 
     Args:
         executable (str): executable name
@@ -17,23 +68,59 @@ def check_command_exists(executable: str) -> None:
         FileNotFoundError: raised if executable is not present in path.
     """
     if shutil.which(executable) is None:
-        raise FileNotFoundError("ssh client is not installed?")
+        raise FileNotFoundError(f"{executable} is not installed (or not in PATH), is the ssh client installed?")
 
 
 def remove_from_known_hosts(hostname: str) -> None:
     """Removes the ip from ssh know_hosts file. This is necessary because we reuse IPs a lot with different keys
-    attached to them and some versions of ssh don't respect the disabling of StrictHostKeyChecking.
+    attached to them and some versions of ssh don't respect the disabling of StrictHostKeyChecking. The file is parsed
+    once per process and only rewritten if the host is actually in it.
 
     Args:
         hostname (str): remote hostname
     """
-    cmd = ["ssh-keygen", "-f", "~/.ssh/known_hosts", "-R", "%s" % hostname]
-    logger.debug(f"Running command: {cmd}")
-    # we don't care about the result here
-    subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if known_hosts.remove_host(hostname):
+        known_hosts.flush()
 
 
-def test_connection(host: str, keyfile: Optional[str], user: str = "gcpfire") -> List[bytes]:
+def port_open(host: str, port: int = 22, timeout: float = 2) -> bool:
+    """Check if the remote accepts TCP connections on the port. Much cheaper than a failing ssh invocation.
+
+    Args:
+        host (str): remote hostname
+        port (int, optional): remote port. Defaults to 22.
+        timeout (float, optional): Seconds to wait for the connection. Defaults to 2.
+
+    Returns:
+        bool: True if the connection could be established.
+    """
+    try:
+        with socket.create_connection((host, port), timeout=timeout):
+            return True
+    except OSError:
+        return False
+
+
+def close_master(host: str, user: str = "gcpfire") -> None:
+    """Stop the multiplexing master connection to the host, if there is one. Without this it would stay around for
+    CONTROL_PERSIST seconds, and IPs are reused a lot: a new instance with the same IP must not get the old connection.
+
+    Args:
+        host (str): remote hostname
+        user (str, optional): remote user name. Defaults to "gcpfire".
+    """
+    # runs in a finally: it must not hide the actual error, e.g. the missing ssh client
+    if shutil.which("ssh") is None:
+        return
+    cmd = ["ssh", "-o", f"ControlPath={control_path()}", "-O", "exit", f"{user}@{host}"]
+    logger.debug("Running command: %s", " ".join(cmd))
+    try:
+        subprocess.run(cmd, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+    except OSError as e:
+        logger.warning(f"Could not close the ssh master connection to {host}: {e}")
+
+
+def test_connection(host: str, keyfile: Optional[str], user: str = "gcpfire") -> bytes:
     """Run a simple command on the remote host to check ssh connection. We just want to propagate the exception of
     invoke_line() so we can initiate a retry if the ssh connection is not ready.
 
@@ -46,17 +133,15 @@ def test_connection(host: str, keyfile: Optional[str], user: str = "gcpfire") ->
         ShellExecutionError: invoke_line raises this error if stderr is present. Contains the stderr buffer.
 
     Returns:
-        List[bytes]: stdout
+        bytes: stdout
     """
-    cmd = ["ssh", "-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null"]
-    if keyfile is not None:
-        cmd.extend(["-i", keyfile])
+    cmd = ["ssh", *ssh_options(keyfile)]
     cmd.append(f"{user}@{host}")
     cmd.append("echo 1")
     return invoke_line(cmd)
 
 
-def ssh_copy_file(host: str, filepath: str, keyfile: Optional[str], user: str = "gcpfire") -> List[bytes]:
+def ssh_copy_file(host: str, filepath: str, keyfile: Optional[str], user: str = "gcpfire") -> bytes:
     """Copy a file over ssh.
 
     Args:
@@ -66,11 +151,9 @@ def ssh_copy_file(host: str, filepath: str, keyfile: Optional[str], user: str =
         user (str, optional): remote user name. Defaults to "gcpfire".
 
     Returns:
-        List[bytes]: stdout (if present)
+        bytes: stdout (empty if not present)
     """
-    cmd = ["scp", "-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null"]
-    if keyfile is not None:
-        cmd.extend(["-i", keyfile])
+    cmd = ["scp", *ssh_options(keyfile)]
     cmd.append(filepath)
     fname = os.path.basename(filepath)
     cmd.append(f"{user}@{host}:~/{fname}")
@@ -79,7 +162,7 @@ def ssh_copy_file(host: str, filepath: str, keyfile: Optional[str], user: str =
 
 def ssh_run_command(
     host: str, remote_cmd: str, keyfile: Optional[str], force_tty: bool = True, user: str = "gcpfire"
-) -> List[bytes]:
+) -> bytes:
     """Run a command on the remote machine over ssh.
 
     Args:
@@ -93,11 +176,9 @@ def ssh_run_command(
         ShellExecutionError: invoke_line raises this error if stderr is present. Contains the stderr buffer.
 
     Returns:
-        List[bytes]: stdout (if present)
+        bytes: stdout (empty if not present)
     """
-    cmd = ["ssh", "-o", "StrictHostKeyChecking=no", "-o", "UserKnownHostsFile=/dev/null"]
-    if keyfile is not None:
-        cmd.extend(["-i", keyfile])
+    cmd = ["ssh", *ssh_options(keyfile)]
     if force_tty:
         cmd.append("-t")
     cmd.append(f"{user}@{host}")
@@ -119,8 +200,10 @@ class ShellExecutionError(Exception):
             return "Error during Remote Execution."
 
 
-def invoke_line(cmd: List[str], strict: bool = False) -> List[bytes]:
-    """Runs a shell command in a subprocess.
+def invoke_line(cmd: List[str], strict: bool = False) -> bytes:
+    """Runs a shell command in a subprocess. Stdout is streamed to the (debug) logger line by line while the command
+    runs, and only the last MAX_OUTPUT_LINES lines are kept, so long-running jobs with lots of output do not pile up in
+    memory. Stderr is drained in a thread, so neither pipe can fill up and block the command.
 
     Args:
         cmd (List[str]): command string split by spaces
@@ -130,20 +213,36 @@ def invoke_line(cmd: List[str], strict: bool = False) -> List[bytes]:
         ShellExecutionError: raised if stderr is present. Contains the stderr buffer.
 
     Returns:
-        List[bytes]: stdout (if present)
+        bytes: stdout (empty if not present), at most the last MAX_OUTPUT_LINES lines.
     """
     check_command_exists(cmd[0])
-    logger.debug("Running command: " + " ".join(cmd))
-    ssh = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    if ssh.stdout is not None:
-        result = ssh.stdout.readlines()
-    if result == []:
-        if ssh.stderr is not None:
-            # only fail for fatal errors
-            stderr = [line for line in ssh.stderr.readlines() if (not line.startswith(b"Warning") or strict)]
-            if len(stderr) > 0:
-                logger.error("ERROR: %s" % stderr)
-                raise ShellExecutionError("ERROR: %s" % stderr, stderr)
-    else:
-        logger.debug(result)
+    logger.debug("Running command: %s", " ".join(cmd))
+    process = subprocess.Popen(cmd, shell=False, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    assert process.stdout is not None and process.stderr is not None
+
+    stderr_lines: List[bytes] = []
+    stderr_stream = process.stderr
+    drain = threading.Thread(target=lambda: stderr_lines.extend(stderr_stream.readlines()), daemon=True)
+    drain.start()
+
+    tail: Deque[bytes] = deque(maxlen=MAX_OUTPUT_LINES)
+    dropped = 0
+    for line in iter(process.stdout.readline, b""):
+        logger.debug("%s", line.decode(errors="replace").rstrip())
+        if len(tail) == MAX_OUTPUT_LINES:
+            dropped += 1
+        tail.append(line)
+    process.wait()
+    drain.join()
+
+    if dropped > 0:
+        logger.warning(f"Output of {cmd[0]} has {dropped + len(tail)} lines, only returning the last {len(tail)}.")
+
+    result = b"".join(tail)
+    if result == b"":
+        # only fail for fatal errors
+        stderr = stderr_lines if strict else [line for line in stderr_lines if not _WARN_RE.match(line)]
+        if len(stderr) > 0:
+            logger.error("ERROR: %s" % stderr)
+            raise ShellExecutionError("ERROR: %s" % stderr, stderr)
     return result
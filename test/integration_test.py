@@ -1,11 +1,16 @@
 import os
-import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
 from logging import DEBUG as loglevel
+from typing import Callable, List
 
 from gcpfire.compute import ComputeAPI
 from gcpfire.job import JobSpec
 from gcpfire.logger import logger
 
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+JOBS_DIR = os.path.join(ROOT_DIR, "jobs")
+
 PROJECT_ID = "main-composite-287415"
 ZONE = "us-east1-c"
 
@@ -15,6 +20,10 @@ logger.debug(f"Starting gcpfire with Project ID: {PROJECT_ID}, Zone: {ZONE}")
 # Set this to False for debugging purposes, because this way we have a higher chance of getting the config we want
 PREEMPTIBLE = False
 
+# The exporter reads the rallies csv the analysis writes, so by default the tasks run one after the other. If the csv
+# already exists, set GCPFIRE_MAX_CONCURRENT=2 to run both at once (every ComputeAPI thread has its own connection).
+MAX_CONCURRENT = int(os.getenv("GCPFIRE_MAX_CONCURRENT", "1"))
+
 # Test Data
 input_uri = "gs://dev-video-input/videos/10_Hegenberger_vs_Ehret/10_Hegenberger_vs_Ehret.mp4"
 rallies_uri = "gs://dev-video-input/analyzed/10_Hegenberger_vs_Ehret/10_Hegenberger_vs_Ehret.csv"
@@ -23,12 +32,8 @@ output_uri = "gs://dev-video-exported/test/10_Hegenberger_vs_Ehret/10_Hegenberge
 
 def analysis_task() -> None:
     """Analysis: Extract Frames & classify rallies"""
-    analysis_job_name = f"analysis-{str(time.time()).split('.')[0]}"
-    analysis_script_path = os.path.join(
-        os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)),
-        "jobs",
-        "analysis.sh",
-    )
+    analysis_job_name = f"analysis-{uuid.uuid4().hex[:8]}"
+    analysis_script_path = os.path.join(JOBS_DIR, "analysis.sh")
     analysis_meta = [
         {"key": "project_id", "value": PROJECT_ID},
         {
@@ -50,17 +55,13 @@ def analysis_task() -> None:
     job = JobSpec(analysis_job_name, analysis_script_path, image_name, machine_type, gpus, PREEMPTIBLE, analysis_meta)
 
     stdout = compute_api.fire(job, wait=True)
-    logger.info(b"".join(stdout).decode("utf-8"))
+    logger.info(stdout.decode("utf-8"))
 
 
 def exporter_task() -> None:
     """Exporter: Use rallies csv to cut & export video"""
-    exporter_job_name = f"exporter-{str(time.time()).split('.')[0]}"
-    exporter_script_path = os.path.join(
-        os.path.abspath(os.path.join(os.path.dirname(__file__), os.pardir)),
-        "jobs",
-        "exporter.sh",
-    )
+    exporter_job_name = f"exporter-{uuid.uuid4().hex[:8]}"
+    exporter_script_path = os.path.join(JOBS_DIR, "exporter.sh")
     exporter_meta = [
         {"key": "project_id", "value": PROJECT_ID},
         {
@@ -84,9 +85,20 @@ def exporter_task() -> None:
     job = JobSpec(exporter_job_name, exporter_script_path, image_name, machine_type, gpus, PREEMPTIBLE, exporter_meta)
 
     stdout = compute_api.fire(job, wait=True)
-    logger.info(b"".join(stdout).decode("utf-8"))
+    logger.info(stdout.decode("utf-8"))
+
+
+def run_tasks(tasks: List[Callable[[], None]], max_concurrent: int = MAX_CONCURRENT) -> None:
+    """Run the tasks in a thread pool, so their waiting for GCP and ssh overlaps. Re-raises the first error."""
+    if max_concurrent <= 1:
+        for task in tasks:
+            task()  # a failed task stops the ones depending on it
+        return
+    with ThreadPoolExecutor(max_workers=max_concurrent) as executor:
+        futures = [executor.submit(task) for task in tasks]
+        for future in futures:
+            future.result()
 
 
 if __name__ == "__main__":
-    analysis_task()
-    exporter_task()
+    run_tasks([analysis_task, exporter_task])
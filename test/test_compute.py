@@ -0,0 +1,327 @@
+import socket
+from concurrent.futures import Future
+from typing import Any, List
+from unittest import mock
+
+import httplib2
+import pytest
+from googleapiclient.errors import HttpError
+
+from gcpfire import compute
+from gcpfire.job import JobSpec
+
+
+@pytest.fixture
+def client(monkeypatch) -> mock.MagicMock:
+    """Compute client of every ComputeAPI in the test, no credentials needed."""
+    client = mock.MagicMock()
+    monkeypatch.setattr(compute, "get_compute_client", lambda: client)
+    return client
+
+
+@pytest.fixture
+def api(client, monkeypatch) -> compute.ComputeAPI:
+    keys: Future = Future()
+    keys.set_result((b"private", b"ssh-ed25519 AAAA gcpfire"))
+    monkeypatch.setattr(compute, "prewarm_keys", lambda: keys)
+    return compute.ComputeAPI("project", "zone")
+
+
+def job(name: str) -> JobSpec:
+    return JobSpec(job_name=name, job_script_path="job.sh", image_name="image")
+
+
+def test_fire_deletes_the_instance_if_the_lookup_fails(api) -> None:
+    with mock.patch.object(api, "get_job_resources", side_effect=RuntimeError("api down")), mock.patch.object(
+        api, "cleanup"
+    ) as cleanup:
+        with pytest.raises(RuntimeError, match="api down"):
+            api.fire(job("job-1"))
+
+    cleanup.assert_called_once()
+    assert cleanup.call_args.args[0].name == "job-1"
+
+
+def test_fire_many_deletes_instances_of_jobs_that_never_ran(api) -> None:
+    jobs = [job(f"job-{i}") for i in range(4)]
+    cleaned: List[str] = []
+
+    def cleanup(instance: Any, *args: Any) -> None:
+        cleaned.append(instance.name)
+        raise RuntimeError("delete failed")
+
+    with mock.patch.object(api, "_create_all", return_value=jobs), mock.patch.object(
+        api, "fire", side_effect=ValueError("job failed")
+    ), mock.patch.object(api, "cleanup", side_effect=cleanup), mock.patch.object(compute, "OperationTracker"):
+        # the error of the job wins over the failing cleanup
+        with pytest.raises(ValueError, match="job failed"):
+            api.fire_many(jobs, max_concurrent=1)
+
+    # job-0 ran (its fire() cleans up), the jobs still waiting were cancelled: a failing delete does not skip the rest
+    assert "job-0" not in cleaned
+    assert {"job-2", "job-3"} <= set(cleaned)
+    assert api.operation_tracker is None
+
+
+def test_fire_many_only_creates_max_concurrent_instances_upfront(api) -> None:
+    jobs = [job(f"job-{i}") for i in range(3)]
+
+    with mock.patch.object(api, "_create_all", return_value=[]) as create_all, mock.patch.object(
+        api, "fire", return_value=b"ok"
+    ), mock.patch.object(compute, "OperationTracker"):
+        assert api.fire_many(jobs, max_concurrent=2) == [b"ok"] * 3
+
+    assert create_all.call_args.args[0] == jobs[:2]
+
+
+@pytest.fixture
+def fire_steps(api, monkeypatch) -> mock.MagicMock:
+    """Mock every API call fire makes after the lookup, so a test only sets what get_job_resources returns."""
+    steps = mock.MagicMock()
+    for name in [
+        "get_job_resources",
+        "create_instance",
+        "start_instance",
+        "get_instance_data",
+        "add_ssh_keys",
+        "attach_private_key",
+        "cleanup",
+    ]:
+        monkeypatch.setattr(api, name, getattr(steps, name))
+    monkeypatch.setattr(compute.Instance, "remote_execute_script", lambda self, **kwargs: b"ok")
+    return steps
+
+
+def test_fire_starts_a_stopped_instance_instead_of_inserting(api, fire_steps) -> None:
+    stopped = {"status": "TERMINATED", "metadata": {"fingerprint": "abc"}}
+    fire_steps.get_job_resources.return_value = ("image-link", None, stopped)
+
+    assert api.fire(job("job-1")) == b"ok"
+
+    fire_steps.create_instance.assert_not_called()
+    fire_steps.start_instance.assert_called_once()
+    assert fire_steps.add_ssh_keys.call_args.kwargs["instance_data"] == stopped
+    # the key is added before the start, the new ip is fetched after it
+    calls = [call[0] for call in fire_steps.mock_calls]
+    assert calls.index("add_ssh_keys") < calls.index("start_instance") < calls.index("get_instance_data")
+
+
+def test_fire_reuses_a_running_instance(api, fire_steps) -> None:
+    running = {"status": "RUNNING", "metadata": {}, "networkInterfaces": [{"accessConfigs": [{"natIP": "10.0.0.1"}]}]}
+    fire_steps.get_job_resources.return_value = ("image-link", None, running)
+
+    assert api.fire(job("job-1")) == b"ok"
+
+    fire_steps.create_instance.assert_not_called()
+    fire_steps.start_instance.assert_not_called()
+    fire_steps.get_instance_data.assert_not_called()
+    fire_steps.add_ssh_keys.assert_called_once()
+
+
+def test_fire_inserts_a_new_instance(api, fire_steps) -> None:
+    fire_steps.get_job_resources.return_value = ("image-link", None, None)
+
+    assert api.fire(job("job-1")) == b"ok"
+
+    fire_steps.create_instance.assert_called_once()
+    fire_steps.start_instance.assert_not_called()
+    fire_steps.attach_private_key.assert_called_once()
+    fire_steps.cleanup.assert_called_once()
+
+
+def test_fire_refuses_to_start_a_stopped_instance_above_the_limit(api, fire_steps) -> None:
+    instances = [{"name": f"other-{i}", "zone": "zones/zone"} for i in range(compute.HARD_LIMIT_MAX_INSTANCES + 1)]
+    fire_steps.get_job_resources.return_value = ("image-link", instances, {"status": "TERMINATED"})
+
+    with pytest.raises(compute.TooManyInstancesError):
+        api.fire(job("job-1"))
+
+    fire_steps.start_instance.assert_not_called()
+
+
+def operation_error(*codes: str) -> dict:
+    return {"name": "op", "status": "DONE", "error": {"errors": [{"code": c, "message": c.lower()} for c in codes]}}
+
+
+@pytest.mark.parametrize(
+    "code, error",
+    [
+        ("ZONE_RESOURCE_POOL_EXHAUSTED", compute.NoResourcesError),
+        ("ZONE_RESOURCE_POOL_EXHAUSTED_WITH_DETAILS", compute.NoResourcesError),
+        ("QUOTA_EXCEEDED", compute.QuotaExceededError),
+    ],
+)
+def test_operation_errors_are_mapped(api, code, error) -> None:
+    with pytest.raises(error, match=code.lower()):
+        api.check_operation(operation_error(code))
+
+
+def test_unknown_and_multiple_operation_errors_are_generic(api) -> None:
+    with pytest.raises(Exception, match="unknown") as unknown:
+        api.check_operation(operation_error("UNKNOWN"))
+    assert type(unknown.value) is Exception
+
+    with pytest.raises(Exception) as multiple:
+        api.check_operation(operation_error("QUOTA_EXCEEDED", "UNKNOWN"))
+    assert type(multiple.value) is Exception
+
+
+def test_wait_for_response_maps_the_error_of_the_done_operation(api, monkeypatch) -> None:
+    results = iter([{"name": "op", "status": "RUNNING"}, operation_error("QUOTA_EXCEEDED")])
+    monkeypatch.setattr(api, "poll_operation", lambda operation: next(results))
+
+    with pytest.raises(compute.QuotaExceededError):
+        api.wait_for_response("op")
+
+
+def test_wait_for_response_returns_the_done_operation(api, monkeypatch) -> None:
+    monkeypatch.setattr(api, "poll_operation", lambda operation: {"name": operation, "status": "DONE"})
+
+    assert api.wait_for_response("op") == {"name": "op", "status": "DONE"}
+
+
+def test_poll_operation_falls_back_to_get_without_wait(api, client, monkeypatch) -> None:
+    monkeypatch.setattr(compute.time, "sleep", lambda seconds: None)
+    operations = client.zoneOperations()
+    operations.wait().execute.side_effect = HttpError(httplib2.Response({"status": 501}), b"")
+    operations.get().execute.return_value = {"name": "op", "status": "DONE"}
+
+    assert api.poll_operation("op") == {"name": "op", "status": "DONE"}
+    assert api.poll_operation("op") == {"name": "op", "status": "DONE"}
+
+    # wait is not tried again once the endpoint told us it does not support it
+    assert operations.wait().execute.call_count == 1
+    assert api.use_operation_wait is False
+
+
+def test_poll_operation_raises_other_errors_of_wait(api, client) -> None:
+    client.zoneOperations().wait().execute.side_effect = HttpError(httplib2.Response({"status": 403}), b"")
+
+    with pytest.raises(HttpError):
+        api.poll_operation("op")
+
+
+def test_poll_operation_reports_a_timed_out_wait_as_running(api, client) -> None:
+    client.zoneOperations().wait().execute.side_effect = socket.timeout("timed out")
+
+    assert api.poll_operation("op") == {"name": "op", "status": "RUNNING"}
+    assert api.use_operation_wait is True
+
+
+def test_list_instances_counts_the_zone_only(api, client) -> None:
+    client.instances().list().execute.return_value = {"items": [{"name": "a", "zone": "zones/zone"}]}
+    client.instances().list.reset_mock()
+
+    assert api.list_instances() == [{"name": "a", "zone": "zones/zone"}]
+
+    kwargs = client.instances().list.call_args.kwargs
+    assert kwargs["zone"] == "zone"
+    assert kwargs["maxResults"] == compute.HARD_LIMIT_MAX_INSTANCES + 1
+    assert "nextPageToken" in kwargs["fields"]
+
+
+def test_list_instances_without_instances(api, client) -> None:
+    client.instances().list().execute.return_value = {}
+
+    assert api.list_instances() is None
+
+
+class FakeBatch:
+    """BatchHttpRequest that answers every request from `responses` (an exception is handed to the callback)."""
+
+    def __init__(self, responses: dict, callback: Any) -> None:
+        self.responses = responses
+        self.callback = callback
+        self.request_ids: List[str] = []
+
+    def add(self, request: Any, request_id: str) -> None:
+        self.request_ids.append(request_id)
+
+    def execute(self) -> None:
+        for request_id in self.request_ids:
+            response = self.responses[request_id]
+            if isinstance(response, Exception):
+                self.callback(request_id, None, response)
+            else:
+                self.callback(request_id, response, None)
+
+
+class FakeBatches:
+    """Hands out FakeBatches that all answer from the same `responses`, and remembers them."""
+
+    def __init__(self) -> None:
+        self.responses: dict = {
+            "image": {"selfLink": "image-link"},
+            "instances": {"items": [{"name": "other", "zone": "zones/zone"}]},
+            "instance": HttpError(httplib2.Response({"status": 404}), b""),
+        }
+        self.batches: List[FakeBatch] = []
+
+    def __call__(self, callback: Any) -> FakeBatch:
+        self.batches.append(FakeBatch(self.responses, callback))
+        return self.batches[-1]
+
+
+@pytest.fixture
+def batches(client, monkeypatch) -> FakeBatches:
+    monkeypatch.setattr(compute, "_image_links", {})
+    client.new_batch_http_request.side_effect = batches = FakeBatches()
+    return batches
+
+
+def test_get_job_resources_in_one_batch(api, batches) -> None:
+    image_link, instances, existing = api.get_job_resources("project", "image", "job-1")
+
+    assert (image_link, instances, existing) == ("image-link", [{"name": "other", "zone": "zones/zone"}], None)
+    assert batches.batches[0].request_ids == ["image", "instances", "instance"]
+
+    # the image link is cached, so the next job does not look it up again
+    assert api.get_job_resources("project", "image", "job-2")[0] == "image-link"
+    assert batches.batches[1].request_ids == ["instances", "instance"]
+
+
+def test_get_job_resources_returns_the_existing_instance(api, batches) -> None:
+    batches.responses.update(instances={}, instance={"status": "RUNNING"})
+
+    assert api.get_job_resources("project", "image", "job-1") == ("image-link", None, {"status": "RUNNING"})
+
+
+def test_get_job_resources_raises_other_errors(api, batches) -> None:
+    batches.responses["image"] = HttpError(httplib2.Response({"status": 403}), b"")
+
+    with pytest.raises(HttpError):
+        api.get_job_resources("project", "image", "job-1")
+
+
+def test_reaper_waits_for_operations_in_the_background(api, monkeypatch, caplog) -> None:
+    waited: List[str] = []
+
+    def wait_for_response(operation: str) -> None:
+        waited.append(operation)
+        if operation == "op-1":
+            raise compute.QuotaExceededError("quota")
+
+    monkeypatch.setattr(api, "wait_for_response", wait_for_response)
+
+    api.reap("op-1")
+    api.reap("op-2")
+    api.wait_for_reaped_operations()
+
+    # a failed operation is only logged and does not stop the reaper
+    assert waited == ["op-1", "op-2"]
+    assert "Operation op-1 failed: quota" in caplog.text
+
+
+def test_cleanup_reaps_the_delete_unless_asked_to_wait(api, monkeypatch) -> None:
+    reap = mock.MagicMock()
+    wait_for_response = mock.MagicMock()
+    monkeypatch.setattr(api, "delete_instance", lambda instance: {"name": "op"})
+    monkeypatch.setattr(api, "reap", reap)
+    monkeypatch.setattr(api, "wait_for_response", wait_for_response)
+
+    api.cleanup(compute.Instance("job-1", "project", "zone"), wait=False)
+    reap.assert_called_once_with("op")
+    wait_for_response.assert_not_called()
+
+    api.cleanup(compute.Instance("job-1", "project", "zone"), wait=False, wait_for_delete=True)
+    wait_for_response.assert_called_once_with("op")
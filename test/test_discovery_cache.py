@@ -0,0 +1,30 @@
+import os
+import time
+
+from gcpfire.discovery_cache import DiscoveryCache
+
+URL = "https://compute.googleapis.com/$discovery/rest?version=v1"
+
+
+def test_set_and_get(tmp_path) -> None:
+    cache = DiscoveryCache(str(tmp_path / "discovery"))
+
+    assert cache.get(URL) is None
+    cache.set(URL, '{"name": "compute"}')
+
+    assert cache.get(URL) == '{"name": "compute"}'
+    assert cache.get(URL + "&other") is None
+
+
+def test_expired_document_is_not_used(tmp_path) -> None:
+    cache = DiscoveryCache(str(tmp_path / "discovery"), ttl=60)
+    cache.set(URL, '{"name": "compute"}')
+
+    # written two minutes ago
+    old = time.time() - 120
+    os.utime(cache._path(URL), (old, old))
+
+    assert cache.get(URL) is None
+    # downloading it again refreshes the cache
+    cache.set(URL, '{"name": "compute", "revision": "2"}')
+    assert cache.get(URL) == '{"name": "compute", "revision": "2"}'
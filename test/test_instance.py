@@ -0,0 +1,112 @@
+import subprocess
+import time
+from unittest import mock
+
+import pytest
+
+from gcpfire import ssh_client as ssh
+from gcpfire.instance import (
+    STARTUP_SCRIPT_COMPRESS_THRESHOLD,
+    Instance,
+    InstanceSpecBuilder,
+    RemoteExecutionError,
+    _compress_script,
+)
+
+
+def metadata(builder: InstanceSpecBuilder) -> dict:
+    return {item["key"]: item["value"] for item in builder.build("project", "zone").config["metadata"]["items"]}
+
+
+def test_ssh_keys_are_merged_with_the_job_metadata() -> None:
+    builder = InstanceSpecBuilder(
+        "job",
+        "image",
+        [{"key": "ssh-keys", "value": "alice:ssh-ed25519 AAAA alice"}, {"key": "input", "value": "gs://in"}],
+        "n1-standard-1",
+        ssh_keys="gcpfire:ssh-ed25519 BBBB gcpfire",
+    )
+
+    items = builder.build("project", "zone").config["metadata"]["items"]
+
+    assert [item["key"] for item in items].count("ssh-keys") == 1
+    assert metadata(builder)["ssh-keys"] == "alice:ssh-ed25519 AAAA alice\ngcpfire:ssh-ed25519 BBBB gcpfire"
+    assert metadata(builder)["input"] == "gs://in"
+
+
+def test_no_ssh_keys() -> None:
+    builder = InstanceSpecBuilder("job", "image", [], "n1-standard-1")
+
+    assert "ssh-keys" not in metadata(builder)
+
+
+def test_compressed_script_runs_with_its_shebang() -> None:
+    script = "#!/usr/bin/env python3\nimport sys\nprint('python')\nsys.exit(3)\n"
+
+    result = subprocess.run(["bash", "-c", _compress_script(script)], stdout=subprocess.PIPE)
+
+    assert result.stdout == b"python\n"
+    assert result.returncode == 3
+
+
+def test_compressed_script_without_shebang_runs_with_bash() -> None:
+    result = subprocess.run(["bash", "-c", _compress_script("echo ${BASH_VERSION:+bash}\n")], stdout=subprocess.PIPE)
+
+    assert result.stdout == b"bash\n"
+
+
+def test_compress_threshold_counts_bytes(tmp_path) -> None:
+    script = tmp_path / "startup.sh"
+    # less characters than the threshold, but more bytes
+    script.write_text("#!/bin/bash\n# " + "ü" * (STARTUP_SCRIPT_COMPRESS_THRESHOLD // 2) + "\n")
+
+    builder = InstanceSpecBuilder("job", "image", [], "n1-standard-1", startup_script_path=str(script))
+
+    assert "base64 -d" in metadata(builder)["startup-script"]
+
+
+@pytest.fixture
+def remote(monkeypatch) -> mock.MagicMock:
+    """Instance with ip and key, whose ssh calls all go to a mock."""
+    calls = mock.MagicMock()
+    for name in ["port_open", "test_connection", "ssh_copy_file", "ssh_run_command", "close_master"]:
+        monkeypatch.setattr(ssh, name, getattr(calls, name))
+    monkeypatch.setattr(ssh, "remove_from_known_hosts", lambda host: None)
+    monkeypatch.setattr(time, "sleep", lambda seconds: None)
+    calls.port_open.return_value = True
+    calls.ssh_run_command.return_value = b"done\n"
+    calls.instance = Instance("job", "project", "zone")
+    calls.instance.external_ip = "10.0.0.1"
+    calls.instance.private_key_file = "key"
+    return calls
+
+
+def test_only_the_connection_test_is_retried(remote) -> None:
+    remote.test_connection.side_effect = [ssh.ShellExecutionError("not yet"), ssh.ShellExecutionError("not yet"), b"1"]
+
+    assert remote.instance.remote_execute_script("job.sh", retry_wait=0) == b"done\n"
+
+    assert remote.test_connection.call_count == 3
+    remote.ssh_copy_file.assert_called_once()
+    remote.ssh_run_command.assert_called_once()
+    remote.close_master.assert_called_once_with("10.0.0.1")
+
+
+def test_a_failing_job_is_not_run_again(remote) -> None:
+    remote.ssh_run_command.side_effect = ssh.ShellExecutionError("job failed", [b"job failed\n"])
+
+    with pytest.raises(RemoteExecutionError, match="job failed"):
+        remote.instance.remote_execute_script("job.sh", retry_wait=0)
+
+    remote.ssh_run_command.assert_called_once()
+    remote.close_master.assert_called_once()
+
+
+def test_connection_retries_are_limited(remote) -> None:
+    remote.test_connection.side_effect = ssh.ShellExecutionError("refused")
+
+    with pytest.raises(RemoteExecutionError, match="refused"):
+        remote.instance.remote_execute_script("job.sh", retry_wait=0, max_retry=3)
+
+    assert remote.test_connection.call_count == 3
+    remote.ssh_copy_file.assert_not_called()
@@ -0,0 +1,43 @@
+import os
+
+from gcpfire import keys
+
+
+def test_keypair_is_cached_in_memory_and_on_disk(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(keys, "_keypair_cache", {})
+    cache_dir = str(tmp_path / "keys")
+
+    private_key, public_key = keys.generate_keypair_cached("alice", cache_dir=cache_dir)
+
+    assert public_key.startswith(b"ssh-ed25519 ") and public_key.endswith(b" alice")
+    assert keys.generate_keypair_cached("alice", cache_dir=cache_dir) == (private_key, public_key)
+
+    # a new process only finds the keypair on disk
+    monkeypatch.setattr(keys, "_keypair_cache", {})
+    assert keys.generate_keypair_cached("alice", cache_dir=cache_dir) == (private_key, public_key)
+
+    private_files = [name for name in os.listdir(cache_dir) if not name.endswith(".pub")]
+    assert len(private_files) == 1
+    assert os.stat(os.path.join(cache_dir, private_files[0])).st_mode & 0o777 == 0o600
+
+
+def test_keypair_per_user_and_algorithm(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(keys, "_keypair_cache", {})
+    cache_dir = str(tmp_path / "keys")
+
+    alice = keys.generate_keypair_cached("alice", cache_dir=cache_dir)
+    bob = keys.generate_keypair_cached("bob", cache_dir=cache_dir)
+    alice_rsa = keys.generate_keypair_cached("alice", algorithm="rsa", cache_dir=cache_dir)
+
+    assert len({alice, bob, alice_rsa}) == 3
+    assert alice_rsa[1].startswith(b"ssh-rsa ")
+
+
+def test_expired_keypair_is_regenerated(tmp_path, monkeypatch) -> None:
+    monkeypatch.setattr(keys, "_keypair_cache", {})
+    cache_dir = str(tmp_path / "keys")
+
+    first = keys.generate_keypair_cached(cache_dir=cache_dir, ttl=0)
+    second = keys.generate_keypair_cached(cache_dir=cache_dir, ttl=0)
+
+    assert first != second
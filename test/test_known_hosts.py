@@ -0,0 +1,95 @@
+import base64
+import hashlib
+import hmac
+import os
+
+from gcpfire.known_hosts import KnownHostsCache
+
+KEY = "ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAIHk8"
+
+
+def hashed_entry(hostname: str) -> str:
+    salt = os.urandom(20)
+    digest = hmac.new(salt, hostname.encode(), hashlib.sha1).digest()
+    return f"|1|{base64.b64encode(salt).decode()}|{base64.b64encode(digest).decode()}"
+
+
+def write_known_hosts(path: str, lines: list) -> None:
+    with open(path, "w") as known_hosts_file:
+        known_hosts_file.writelines(line + "\n" for line in lines)
+
+
+def read_known_hosts(path: str) -> list:
+    with open(path) as known_hosts_file:
+        return known_hosts_file.read().splitlines()
+
+
+def test_remove_plain_bracketed_and_hashed_entries(tmp_path) -> None:
+    path = str(tmp_path / "known_hosts")
+    lines = [
+        "# a comment mentioning 10.0.0.1",
+        f"10.0.0.1 {KEY}",
+        f"[10.0.0.1]:2222 {KEY}",
+        f"{hashed_entry('10.0.0.1')} {KEY}",
+        f"10.0.0.2,other.example {KEY}",
+        f"{hashed_entry('10.0.0.3')} {KEY}",
+        "",
+    ]
+    write_known_hosts(path, lines)
+
+    cache = KnownHostsCache(path)
+    assert cache.remove_host("10.0.0.1")
+    cache.flush()
+
+    assert read_known_hosts(path) == [lines[0], lines[4], lines[5], ""]
+
+
+def test_remove_hashed_entry(tmp_path) -> None:
+    path = str(tmp_path / "known_hosts")
+    lines = [f"{hashed_entry('10.0.0.3')} {KEY}", f"10.0.0.2 {KEY}"]
+    write_known_hosts(path, lines)
+
+    cache = KnownHostsCache(path)
+    assert cache.remove_host("10.0.0.3")
+    cache.flush()
+
+    assert read_known_hosts(path) == [lines[1]]
+
+
+def test_unknown_host_does_not_rewrite_the_file(tmp_path) -> None:
+    path = str(tmp_path / "known_hosts")
+    write_known_hosts(path, [f"10.0.0.2 {KEY}"])
+    mtime = os.stat(path).st_mtime_ns
+
+    cache = KnownHostsCache(path)
+    assert not cache.remove_host("10.0.0.1")
+    cache.flush()
+
+    assert os.stat(path).st_mtime_ns == mtime
+
+
+def test_flush_is_idempotent_and_keeps_new_entries(tmp_path) -> None:
+    path = str(tmp_path / "known_hosts")
+    write_known_hosts(path, [f"10.0.0.1 {KEY}", f"10.0.0.2 {KEY}"])
+    os.chmod(path, 0o600)
+
+    cache = KnownHostsCache(path)
+    cache.remove_host("10.0.0.1")
+    cache.flush()
+    # another ssh client adds an entry between our flushes
+    with open(path, "a") as known_hosts_file:
+        known_hosts_file.write(f"10.0.0.1 {KEY}\n")
+    cache.flush()
+
+    assert read_known_hosts(path) == [f"10.0.0.2 {KEY}", f"10.0.0.1 {KEY}"]
+    assert os.stat(path).st_mode & 0o777 == 0o600
+
+
+def test_missing_file(tmp_path) -> None:
+    path = str(tmp_path / "known_hosts")
+
+    cache = KnownHostsCache(path)
+    assert not cache.remove_host("10.0.0.1")
+    cache.flush()
+
+    assert not os.path.exists(path)
@@ -0,0 +1,36 @@
+import json
+
+from gcpfire.model import OrjsonModel
+
+
+def test_serialize_ascii_body() -> None:
+    body = {"name": "job", "metadata": {"items": [{"key": "startup-script", "value": "#!/bin/bash\necho hi"}]}}
+
+    serialized = OrjsonModel(data_wrapper=False).serialize(body)
+
+    assert isinstance(serialized, str)
+    assert json.loads(serialized) == body
+
+
+def test_serialize_non_ascii_body_is_escaped() -> None:
+    body = {"description": "Grüße"}
+
+    serialized = OrjsonModel(data_wrapper=False).serialize(body)
+
+    # batch requests use the string length as content-length, so the body has to stay ascii
+    assert serialized.isascii()
+    assert json.loads(serialized) == body
+
+
+def test_data_wrapper() -> None:
+    model = OrjsonModel(data_wrapper=True)
+
+    assert json.loads(model.serialize({"a": 1})) == {"data": {"a": 1}}
+    assert model.deserialize(b'{"data": {"a": 1}}') == {"a": 1}
+
+
+def test_deserialize() -> None:
+    model = OrjsonModel(data_wrapper=False)
+
+    assert model.deserialize(b'{"items": [{"status": "DONE"}]}') == {"items": [{"status": "DONE"}]}
+    assert model.deserialize('{"status": "RUNNING"}') == {"status": "RUNNING"}
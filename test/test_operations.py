@@ -0,0 +1,57 @@
+from concurrent.futures import Future
+from unittest import mock
+
+import pytest
+
+from gcpfire.operations import OperationTracker
+
+
+def mock_compute(*ticks: list) -> mock.MagicMock:
+    """Compute client whose zoneOperations().list returns the given items, one list per tick."""
+    compute = mock.MagicMock()
+    compute.zoneOperations().list().execute.side_effect = [{"items": items} for items in ticks]
+    compute.zoneOperations().list_next.return_value = None
+    return compute
+
+
+def test_resolves_every_operation_once_done() -> None:
+    compute = mock_compute(
+        [{"name": "op-1", "status": "DONE"}, {"name": "op-2", "status": "RUNNING"}],
+        [{"name": "op-2", "status": "DONE", "error": {"errors": []}}],
+    )
+    tracker = OperationTracker(compute, "project", "zone", min_interval=0.01, max_interval=0.01)
+
+    first = tracker.wait_async("op-1")
+    second = tracker.wait_async("op-2")
+
+    assert first.result(timeout=5) == {"name": "op-1", "status": "DONE"}
+    assert second.result(timeout=5) == {"name": "op-2", "status": "DONE", "error": {"errors": []}}
+    assert tracker.pending == {}
+
+
+def test_lists_all_pending_operations_with_one_call() -> None:
+    compute = mock_compute([{"name": "op-1", "status": "DONE"}, {"name": "op-2", "status": "DONE"}])
+    list_operations = compute.zoneOperations().list
+    list_operations.reset_mock()
+    tracker = OperationTracker(compute, "project", "zone", min_interval=0.01)
+    # register both before the poller runs its first tick
+    first: Future = Future()
+    tracker.pending["op-1"] = first
+    second = tracker.wait_async("op-2")
+
+    assert first.result(timeout=5)["name"] == "op-1"
+    assert second.result(timeout=5)["name"] == "op-2"
+    list_operations.assert_called_once()
+    assert list_operations.call_args.kwargs["filter"] == 'name eq "(op-1|op-2)"'
+
+
+def test_list_error_fails_every_waiting_operation() -> None:
+    compute = mock.MagicMock()
+    compute.zoneOperations().list().execute.side_effect = RuntimeError("api down")
+    tracker = OperationTracker(compute, "project", "zone", min_interval=0.01)
+
+    future = tracker.wait_async("op-1")
+
+    with pytest.raises(RuntimeError, match="api down"):
+        future.result(timeout=5)
+    assert tracker.pending == {}
@@ -0,0 +1,42 @@
+import logging
+import os
+
+from gcpfire import ssh_client
+
+
+def test_invoke_line_keeps_the_tail_of_long_output(caplog) -> None:
+    with caplog.at_level(logging.WARNING):
+        output = ssh_client.invoke_line(["seq", str(ssh_client.MAX_OUTPUT_LINES + 5)])
+
+    lines = output.splitlines()
+    assert len(lines) == ssh_client.MAX_OUTPUT_LINES
+    assert lines[0] == b"6" and lines[-1] == str(ssh_client.MAX_OUTPUT_LINES + 5).encode()
+    assert "only returning the last" in caplog.text
+
+
+def test_invoke_line_short_output_is_not_truncated(caplog) -> None:
+    with caplog.at_level(logging.WARNING):
+        assert ssh_client.invoke_line(["seq", "3"]) == b"1\n2\n3\n"
+
+    assert caplog.text == ""
+
+
+def test_close_master_without_ssh_client(monkeypatch) -> None:
+    monkeypatch.setenv("PATH", "")
+
+    ssh_client.close_master("10.0.0.1")
+
+
+def test_control_path_is_in_a_private_directory(tmp_path, monkeypatch) -> None:
+    control_dir = str(tmp_path / "ssh")
+    monkeypatch.setattr(ssh_client, "CONTROL_DIR", control_dir)
+    monkeypatch.setattr(ssh_client, "CONTROL_PATH", os.path.join(control_dir, "%C"))
+    ssh_client.control_path.cache_clear()
+    os.makedirs(control_dir, mode=0o755)
+    os.chmod(control_dir, 0o755)
+
+    options = ssh_client.ssh_options("key")
+    ssh_client.control_path.cache_clear()
+
+    assert f"ControlPath={control_dir}/%C" in options
+    assert os.stat(control_dir).st_mode & 0o777 == 0o700